@@ -33,6 +33,7 @@ import boto.exception
 import boto.plugin
 import boto.utils
 import hmac
+import re
 import sys
 import time
 import urllib
@@ -88,7 +89,7 @@ class HmacKeys(object):
             return 'HmacSHA1'
 
     def sign_string(self, string_to_sign):
-        boto.log.debug('Canonical: %s' % string_to_sign)
+        boto.log.debug('Canonical: %s', string_to_sign)
         if self._hmac_256:
             hmac = self._hmac_256.copy()
         else:
@@ -181,7 +182,7 @@ class QuerySignatureHelper(HmacKeys):
         qs, signature = self._calc_signature(
             http_request.params, http_request.method,
             http_request.path, server_name)
-        boto.log.debug('query_string: %s Signature: %s' % (qs, signature))
+        boto.log.debug('query_string: %s Signature: %s', qs, signature)
         if http_request.method == 'POST':
             headers['Content-Type'] = 'application/x-www-form-urlencoded; charset=UTF-8'
             http_request.body = qs + '&Signature=' + urllib.quote(signature)
@@ -251,6 +252,34 @@ class QuerySignatureV1AuthHandler(QuerySignatureHelper, AuthHandler):
         qs = '&'.join(pairs)
         return (qs, base64.b64encode(hmac.digest()))
 
+# Most parameters (names and values alike) repeat from request to request,
+# so their quoted forms are kept, up to a limit.
+_quoted_pairs = {}
+_MAX_QUOTED_PAIRS = 1024
+_MAX_PRIMED_HMACS = 64
+_unreserved = re.compile(r'[A-Za-z0-9_.~-]*\Z')
+
+def _quote_value(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    if _unreserved.match(value):
+        return value
+    return urllib.quote(value, safe='-_~')
+
+def _quote_pair(key, value):
+    if not isinstance(value, basestring):
+        # Not cached: 1 == True, but they are sent differently
+        return urllib.quote(key, safe='') + '=' + _quote_value(value)
+    pair = _quoted_pairs.get((key, value))
+    if pair is None:
+        if len(_quoted_pairs) >= _MAX_QUOTED_PAIRS:
+            _quoted_pairs.clear()
+        pair = urllib.quote(key, safe='') + '=' + _quote_value(value)
+        _quoted_pairs[(key, value)] = pair
+    return pair
+
 class QuerySignatureV2AuthHandler(QuerySignatureHelper, AuthHandler):
     """Provides Query Signature V2 Authentication."""
 
@@ -258,30 +287,37 @@ class QuerySignatureV2AuthHandler(QuerySignatureHelper, AuthHandler):
     capability = ['sign-v2', 'ec2', 'ec2', 'emr', 'fps', 'ecs',
                   'sdb', 'iam', 'rds', 'sns', 'sqs']
 
+    def __init__(self, host, config, provider):
+        QuerySignatureHelper.__init__(self, host, config, provider)
+        # HMACs which have already been fed the start of the string to
+        # sign, by (verb, server name, path)
+        self._primed_hmacs = {}
+
+    def _primed_hmac(self, verb, server_name, path):
+        key = (verb, server_name, path)
+        primed = self._primed_hmacs.get(key)
+        if primed is None:
+            if self._hmac_256:
+                primed = self._hmac_256.copy()
+            else:
+                primed = self._hmac.copy()
+            primed.update('%s\n%s\n%s\n' % (verb, server_name.lower(), path))
+            if len(self._primed_hmacs) >= _MAX_PRIMED_HMACS:
+                self._primed_hmacs.clear()
+            self._primed_hmacs[key] = primed
+        return primed.copy()
+
     def _calc_signature(self, params, verb, path, server_name):
         boto.log.debug('using _calc_signature_2')
-        string_to_sign = '%s\n%s\n%s\n' % (verb, server_name.lower(), path)
-        if self._hmac_256:
-            hmac = self._hmac_256.copy()
-            params['SignatureMethod'] = 'HmacSHA256'
-        else:
-            hmac = self._hmac.copy()
-            params['SignatureMethod'] = 'HmacSHA1'
+        hmac = self._primed_hmac(verb, server_name, path)
+        params['SignatureMethod'] = self.algorithm()
         keys = params.keys()
         keys.sort()
-        pairs = []
-        for key in keys:
-            val = boto.utils.get_utf8_value(params[key])
-            pairs.append(urllib.quote(key, safe='') + '=' +
-                         urllib.quote(val, safe='-_~'))
-        qs = '&'.join(pairs)
-        boto.log.debug('query string: %s' % qs)
-        string_to_sign += qs
-        boto.log.debug('string_to_sign: %s' % string_to_sign)
-        hmac.update(string_to_sign)
+        qs = '&'.join([_quote_pair(key, params[key]) for key in keys])
+        boto.log.debug('query string: %s', qs)
+        hmac.update(qs)
         b64 = base64.b64encode(hmac.digest())
-        boto.log.debug('len(b64)=%d' % len(b64))
-        boto.log.debug('base64 encoded digest: %s' % b64)
+        boto.log.debug('base64 encoded digest: %s', b64)
         return (qs, b64)
 
 
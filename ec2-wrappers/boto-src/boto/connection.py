@@ -45,10 +45,11 @@ import base64
 import errno
 import httplib
 import os
-import Queue
 import re
+import select
 import socket
 import sys
+import threading
 import time
 import urllib, urlparse
 import xml.sax
@@ -66,15 +67,183 @@ from boto.resultset import ResultSet
 
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 
-class ConnectionPool:
-    def __init__(self, hosts, connections_per_host):
+class ConnectionPool(object):
+    """
+    A thread-safe pool of idle HTTP connections, kept per host for up to
+    hosts hosts, and up to connections_per_host idle connections for each.
+
+    Connections are checked before they are reused: one which has been idle
+    longer than max_idle_time seconds, is older than max_age seconds (if
+    set), or whose server has already closed its end is discarded rather
+    than handed out to fail.  Idle connections past max_idle_time are also
+    reaped from time to time.  If max_active_per_host is set, no more than
+    that many connections to a host are handed out at once; get() waits for
+    one to be returned.
+
+    The stats() counters are: hits (an idle connection was reused), misses
+    (a new one was made), stale (idle connections discarded), busy (pooled
+    connections dropped because their last response was still being read),
+    reconnects (connections replaced after an error), overflows (connections
+    closed because the pool was full) and waits (gets which blocked on
+    max_active_per_host).
+    """
+
+    def __init__(self, hosts, connections_per_host, max_idle_time=50,
+                 max_age=None, max_active_per_host=None):
         self._hosts = boto.utils.LRUCache(hosts)
         self.connections_per_host = connections_per_host
+        self.max_idle_time = max_idle_time
+        self.max_age = max_age
+        self.max_active_per_host = max_active_per_host
+        self._active = {}
+        self._condition = threading.Condition()
+        self._last_reap = time.time()
+        self._stats = dict.fromkeys(('hits', 'misses', 'stale', 'busy',
+                                     'reconnects', 'overflows', 'waits'), 0)
+
+    def _is_usable(self, connection, now):
+        if now - connection._pool_last_used > self.max_idle_time:
+            return False
+        if self.max_age and now - connection._pool_created > self.max_age:
+            return False
+        sock = connection.sock
+        if sock is None:
+            # Not connected yet, or closed; httplib will connect as needed
+            return True
+        try:
+            # An idle socket has nothing to read: if it is readable, the
+            # server has closed its end (or sent something unexpected).
+            return not select.select([sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def _is_busy(self, connection):
+        # A response which was returned along with its connection but has
+        # not been read to the end yet.
+        response = getattr(connection, '_HTTPConnection__response', None)
+        return response is not None and not response.isclosed()
+
+    def get(self, key, new_connection):
+        """
+        Return an idle connection to a host, or new_connection() if there
+        is none fit for use.  The caller must give it back with put() or
+        discard().
+        """
+        now = time.time()
+        self._condition.acquire()
+        try:
+            if self.max_active_per_host and \
+                    self._active.get(key, 0) >= self.max_active_per_host:
+                self._stats['waits'] += 1
+                while self._active.get(key, 0) >= self.max_active_per_host:
+                    self._condition.wait()
+            self._active[key] = self._active.get(key, 0) + 1
+            if key in self._hosts:
+                idle = self._hosts[key]
+            else:
+                idle = []
+            while idle:
+                connection = idle.pop()
+                if self._is_busy(connection):
+                    self._stats['busy'] += 1
+                elif self._is_usable(connection, now):
+                    self._stats['hits'] += 1
+                    return connection
+                else:
+                    self._stats['stale'] += 1
+                    connection.close()
+            self._stats['misses'] += 1
+        finally:
+            self._condition.release()
+        try:
+            connection = new_connection()
+        except:
+            self._release(key)
+            raise
+        connection._pool_created = time.time()
+        return connection
+
+    def put(self, key, connection):
+        """
+        Return a connection to the pool, to be reused.
+        """
+        now = time.time()
+        connection._pool_last_used = now
+        self._condition.acquire()
+        try:
+            if key not in self._hosts:
+                self._hosts[key] = []
+            idle = self._hosts[key]
+            if len(idle) < self.connections_per_host:
+                idle.append(connection)
+                connection = None
+            else:
+                self._stats['overflows'] += 1
+            self._release(key)
+            if now - self._last_reap > self.max_idle_time:
+                self._reap(now)
+        finally:
+            self._condition.release()
+        if connection is not None:
+            connection.close()
+
+    def discard(self, key, connection):
+        """
+        Close a connection from get() which is not to be reused.
+        """
+        connection.close()
+        self._condition.acquire()
+        try:
+            self._release(key)
+        finally:
+            self._condition.release()
 
-    def __getitem__(self, key):
-        if key not in self._hosts:
-            self._hosts[key] = Queue.Queue(self.connections_per_host)
-        return self._hosts[key]
+    def replace(self, key, connection, new_connection):
+        """
+        Close a connection from get() which has failed, and return
+        new_connection() in its place, keeping its slot.  If
+        new_connection() raises, the slot is still the caller's, to give
+        up with discard(key, connection).
+        """
+        connection.close()
+        self._condition.acquire()
+        try:
+            self._stats['reconnects'] += 1
+        finally:
+            self._condition.release()
+        new = new_connection()
+        new._pool_created = time.time()
+        return new
+
+    def _release(self, key):
+        # Called with the condition held
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+        self._condition.notifyAll()
+
+    def _reap(self, now):
+        # Called with the condition held
+        self._last_reap = now
+        for item in self._hosts._dict.values():
+            idle = item.value
+            fresh = [connection for connection in idle
+                     if now - connection._pool_last_used <= self.max_idle_time]
+            for connection in idle:
+                if connection not in fresh:
+                    self._stats['stale'] += 1
+                    connection.close()
+            idle[:] = fresh
+
+    def stats(self):
+        """
+        Return a dict of the pool's counters.
+        """
+        self._condition.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._condition.release()
 
     def __repr__(self):
         return 'ConnectionPool:%s' % ','.join(self._hosts._dict.keys())
@@ -212,7 +381,11 @@ class AWSAuthConnection(object):
             self.host = self.provider.host
 
         # cache up to 20 connections per host, up to 20 hosts
-        self._pool = ConnectionPool(20, 20)
+        max_active = config.getint('Boto', 'max_connections_per_host', 0)
+        self._pool = ConnectionPool(20, 20,
+            max_idle_time=config.getfloat('Boto', 'connection_idle_time', 50),
+            max_age=config.getfloat('Boto', 'connection_max_age', 0) or None,
+            max_active_per_host=max_active or None)
         self._connection = (self.server_name(), self.is_secure)
         self._last_rs = None
         self._auth_handler = auth.get_auth_handler(
@@ -322,11 +495,8 @@ class AWSAuthConnection(object):
         self.use_proxy = (self.proxy != None)
 
     def get_http_connection(self, host, is_secure):
-        queue = self._pool[self._cached_name(host, is_secure)]
-        try:
-            return queue.get_nowait()
-        except Queue.Empty:
-            return self.new_http_connection(host, is_secure)
+        return self._pool.get(self._cached_name(host, is_secure),
+                              lambda: self.new_http_connection(host, is_secure))
 
     def new_http_connection(self, host, is_secure):
         if self.use_proxy:
@@ -354,11 +524,22 @@ class AWSAuthConnection(object):
         return connection
 
     def put_http_connection(self, host, is_secure, connection):
-        try:
-            self._pool[self._cached_name(host, is_secure)].put_nowait(connection)
-        except Queue.Full:
-            # gracefully fail in case of pool overflow
-            connection.close()
+        self._pool.put(self._cached_name(host, is_secure), connection)
+
+    def discard_http_connection(self, host, is_secure, connection):
+        self._pool.discard(self._cached_name(host, is_secure), connection)
+
+    def replace_http_connection(self, host, is_secure, connection):
+        return self._pool.replace(self._cached_name(host, is_secure),
+                                  connection,
+                                  lambda: self.new_http_connection(host,
+                                                                   is_secure))
+
+    def get_pool_stats(self):
+        """
+        Return the connection pool's counters: see ConnectionPool.
+        """
+        return self._pool.stats()
 
     def proxy_ssl(self):
         host = '%s:%d' % (self.host, self.port)
@@ -429,50 +610,66 @@ class AWSAuthConnection(object):
         else:
             num_retries = override_num_retries
         i = 0
-        connection = self.get_http_connection(host, self.is_secure)
-        while i <= num_retries:
-            try:
-                if callable(sender):
-                    response = sender(connection, method, path, data, headers)
-                else:
-                    connection.request(method, path, data, headers)
-                    response = connection.getresponse()
-                location = response.getheader('location')
-                # -- gross hack --
-                # httplib gets confused with chunked responses to HEAD requests
-                # so I have to fake it out
-                if method == 'HEAD' and getattr(response, 'chunked', False):
-                    response.chunked = 0
-                if response.status == 500 or response.status == 503:
-                    boto.log.debug('received %d response, retrying in %d seconds' % (response.status, 2 ** i))
-                    body = response.read()
-                elif response.status == 408:
-                    body = response.read()
-                    print '-------------------------'
-                    print '         4 0 8           '
-                    print 'path=%s' % path
-                    print body
-                    print '-------------------------'
-                elif response.status < 300 or response.status >= 400 or \
-                        not location:
-                    self.put_http_connection(host, self.is_secure, connection)
-                    return response
-                else:
-                    scheme, host, path, params, query, fragment = \
-                            urlparse.urlparse(location)
-                    if query:
-                        path += '?' + query
-                    boto.log.debug('Redirecting: %s' % scheme + '://' + host + path)
-                    connection = self.get_http_connection(host, scheme == 'https')
-                    continue
-            except KeyboardInterrupt:
-                sys.exit('Keyboard Interrupt')
-            except self.http_exceptions, e:
-                boto.log.debug('encountered %s exception, reconnecting' % \
-                                  e.__class__.__name__)
-                connection = self.new_http_connection(host, self.is_secure)
-            time.sleep(2 ** i)
-            i += 1
+        is_secure = self.is_secure
+        connection = self.get_http_connection(host, is_secure)
+        try:
+            while i <= num_retries:
+                try:
+                    if callable(sender):
+                        response = sender(connection, method, path, data, headers)
+                    else:
+                        connection.request(method, path, data, headers)
+                        response = connection.getresponse()
+                    location = response.getheader('location')
+                    # -- gross hack --
+                    # httplib gets confused with chunked responses to HEAD requests
+                    # so I have to fake it out
+                    if method == 'HEAD' and getattr(response, 'chunked', False):
+                        response.chunked = 0
+                    if response.status == 500 or response.status == 503:
+                        boto.log.debug('received %d response, retrying in %d seconds' % (response.status, 2 ** i))
+                        body = response.read()
+                    elif response.status == 408:
+                        body = response.read()
+                        print '-------------------------'
+                        print '         4 0 8           '
+                        print 'path=%s' % path
+                        print body
+                        print '-------------------------'
+                    elif response.status < 300 or response.status >= 400 or \
+                            not location:
+                        self.put_http_connection(host, is_secure, connection)
+                        connection = None
+                        return response
+                    else:
+                        self.discard_http_connection(host, is_secure, connection)
+                        connection = None
+                        scheme, host, path, params, query, fragment = \
+                                urlparse.urlparse(location)
+                        if query:
+                            path += '?' + query
+                        boto.log.debug('Redirecting: %s' % scheme + '://' + host + path)
+                        is_secure = scheme == 'https'
+                        connection = self.get_http_connection(host, is_secure)
+                        continue
+                except KeyboardInterrupt:
+                    sys.exit('Keyboard Interrupt')
+                except self.http_exceptions, e:
+                    boto.log.debug('encountered %s exception, reconnecting' % \
+                                      e.__class__.__name__)
+                    # A kept-alive connection can still have been closed by
+                    # the server in the moment before it was used; that is
+                    # no reason to back off.
+                    reused = hasattr(connection, '_pool_last_used')
+                    connection = self.replace_http_connection(host, is_secure,
+                                                              connection)
+                    if reused:
+                        continue
+                time.sleep(2 ** i)
+                i += 1
+        finally:
+            if connection is not None:
+                self.discard_http_connection(host, is_secure, connection)
         # If we made it here, it's because we have exhausted our retries and stil haven't
         # succeeded.  So, if we have a response object, use it to raise an exception.
         # Otherwise, raise the exception that must have already happened.
@@ -590,6 +787,55 @@ class AWSQueryConnection(AWSAuthConnection):
             boto.log.error('%s' % body)
             raise self.ResponseError(response.status, response.reason, body)
 
+    def get_list_iter(self, action, params, markers, path='/', parent=None,
+                      verb='GET', rs=None, chunk_size=16384):
+        """
+        Like get_list, but a generator which parses the response as it is
+        read from the socket and yields each marker object as soon as its
+        element is complete, so the whole response is never held in memory.
+
+        :type rs: :class:`boto.resultset.ResultSet`
+        :param rs: Optional empty ResultSet to parse into, in place of a
+                   new one.  Its attributes (next_token and so on) are set
+                   as the response is read, but the objects are removed
+                   from it once yielded.
+        """
+        if not parent:
+            parent = self
+        response = self.make_request(action, params, path, verb)
+        if response.status != 200:
+            body = response.read()
+            boto.log.error('%s %s' % (response.status, response.reason))
+            boto.log.error('%s' % body)
+            raise self.ResponseError(response.status, response.reason, body)
+        if rs is None:
+            rs = ResultSet(markers)
+        else:
+            rs.markers = markers
+        h = handler.XmlHandler(rs, parent)
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(h)
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            # While the handler is below the root, the last object in the
+            # ResultSet is still being filled in.
+            complete = len(rs)
+            if len(h.nodes) > 1:
+                complete -= 1
+            if complete > 0:
+                objs = rs[:complete]
+                del rs[:complete]
+                for obj in objs:
+                    yield obj
+        parser.close()
+        objs = rs[:]
+        del rs[:]
+        for obj in objs:
+            yield obj
+
     def get_object(self, action, params, cls, path='/', parent=None, verb='GET'):
         if not parent:
             parent = self
@@ -0,0 +1,366 @@
+# Copyright (c) 2006-2010 Mitch Garnaat http://garnaat.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+"""
+Compact, read-only representations of EC2 reservations, instances and spot
+instance requests, for listing large accounts.
+
+These keep only the commonly used fields, in __slots__ rather than a
+per-object __dict__, and share one copy of each of the values that repeat
+across objects (states, instance types, zones and so on).  Elements they
+do not know about are skipped rather than set as attributes.  Pass
+compact=True to EC2Connection.get_all_instances, iter_all_instances or
+get_all_spot_instance_requests to get them.
+
+Run "python -m boto.ec2.compact [reservations]" to compare them with the
+full classes.
+"""
+
+import sys
+import time
+import xml.sax
+
+_shared = {}
+
+def share(value):
+    """
+    Return the shared copy of a string value.  Unlike intern(), this also
+    works for the unicode strings the parser produces.
+    """
+    return _shared.setdefault(value, value)
+
+class _Skip(object):
+    """
+    Swallows an element and everything inside it.
+    """
+    __slots__ = ()
+
+    def startElement(self, name, attrs, connection):
+        return None
+
+    def endElement(self, name, value, connection):
+        pass
+
+_skip = _Skip()
+
+class CompactList(list):
+    """
+    A list which creates an object of the given class for each item element.
+    """
+    __slots__ = ('item_class',)
+
+    def __init__(self, item_class):
+        list.__init__(self)
+        self.item_class = item_class
+
+    def startElement(self, name, attrs, connection):
+        if name == 'item':
+            obj = self.item_class(connection)
+            self.append(obj)
+            return obj
+        return None
+
+    def endElement(self, name, value, connection):
+        pass
+
+class GroupNameList(list):
+    """
+    A list of the names of the groups in a groupSet.
+    """
+    __slots__ = ()
+
+    def startElement(self, name, attrs, connection):
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'groupId':
+            self.append(share(value))
+
+class CompactGroup(object):
+    __slots__ = ('id',)
+
+    def __init__(self, connection=None):
+        self.id = None
+
+    def __repr__(self):
+        return 'Group:%s' % self.id
+
+    def startElement(self, name, attrs, connection):
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'groupId':
+            self.id = share(value)
+
+class CompactReservation(object):
+    __slots__ = ('id', 'owner_id', 'groups', 'instances')
+
+    def __init__(self, connection=None):
+        self.id = None
+        self.owner_id = None
+        self.groups = []
+        self.instances = []
+
+    def __repr__(self):
+        return 'Reservation:%s' % self.id
+
+    def startElement(self, name, attrs, connection):
+        if name == 'instancesSet':
+            self.instances = CompactList(CompactInstance)
+            return self.instances
+        elif name == 'groupSet':
+            self.groups = CompactList(CompactGroup)
+            return self.groups
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'reservationId':
+            self.id = value
+        elif name == 'ownerId':
+            self.owner_id = share(value)
+
+class CompactInstance(object):
+    __slots__ = ('id', 'image_id', 'dns_name', 'private_dns_name', 'state',
+                 'state_code', 'key_name', 'instance_type', 'launch_time',
+                 'placement', 'spot_instance_request_id', 'ip_address',
+                 'private_ip_address')
+
+    # Elements whose contents would be mistaken for the instance's own
+    _skipped = ('tagSet', 'blockDeviceMapping', 'productCodes', 'stateReason',
+                'monitoring', 'groupSet')
+
+    def __init__(self, connection=None):
+        self.id = None
+        self.image_id = None
+        self.dns_name = None
+        self.private_dns_name = None
+        self.state = None
+        self.state_code = None
+        self.key_name = None
+        self.instance_type = None
+        self.launch_time = None
+        self.placement = None
+        self.spot_instance_request_id = None
+        self.ip_address = None
+        self.private_ip_address = None
+
+    def __repr__(self):
+        return 'Instance:%s' % self.id
+
+    @property
+    def public_dns_name(self):
+        return self.dns_name
+
+    def startElement(self, name, attrs, connection):
+        if name in self._skipped:
+            return _skip
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'instanceId':
+            self.id = value
+        elif name == 'imageId':
+            self.image_id = share(value)
+        elif name == 'dnsName' or name == 'publicDnsName':
+            self.dns_name = value
+        elif name == 'privateDnsName':
+            self.private_dns_name = value
+        elif name == 'name':
+            self.state = share(value)
+        elif name == 'code':
+            try:
+                self.state_code = int(value)
+            except ValueError:
+                self.state_code = value
+        elif name == 'keyName':
+            self.key_name = share(value)
+        elif name == 'instanceType':
+            self.instance_type = share(value)
+        elif name == 'launchTime':
+            self.launch_time = value
+        elif name == 'availabilityZone':
+            self.placement = share(value)
+        elif name == 'spotInstanceRequestId':
+            self.spot_instance_request_id = value
+        elif name == 'ipAddress':
+            self.ip_address = value
+        elif name == 'privateIpAddress':
+            self.private_ip_address = value
+
+class CompactLaunchSpecification(object):
+    __slots__ = ('key_name', 'instance_type', 'image_id', 'groups',
+                 'placement')
+
+    _skipped = ('blockDeviceMapping', 'monitoring')
+
+    def __init__(self, connection=None):
+        self.key_name = None
+        self.instance_type = None
+        self.image_id = None
+        self.groups = []
+        self.placement = None
+
+    def __repr__(self):
+        return 'LaunchSpecification(%s)' % self.image_id
+
+    def startElement(self, name, attrs, connection):
+        if name == 'groupSet':
+            self.groups = GroupNameList()
+            return self.groups
+        elif name in self._skipped:
+            return _skip
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'imageId':
+            self.image_id = share(value)
+        elif name == 'keyName':
+            self.key_name = share(value)
+        elif name == 'instanceType':
+            self.instance_type = share(value)
+        elif name == 'availabilityZone':
+            self.placement = share(value)
+
+class CompactSpotInstanceRequest(object):
+    """
+    Unlike SpotInstanceRequest, launch_specification.groups is a list of
+    group names rather than of Group objects.
+    """
+    __slots__ = ('connection', 'id', 'price', 'type', 'state', 'create_time',
+                 'launch_specification', 'instance_id')
+
+    _skipped = ('tagSet', 'fault')
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.id = None
+        self.price = None
+        self.type = None
+        self.state = None
+        self.create_time = None
+        self.launch_specification = None
+        self.instance_id = None
+
+    def __repr__(self):
+        return 'SpotInstanceRequest:%s' % self.id
+
+    def startElement(self, name, attrs, connection):
+        if name == 'launchSpecification':
+            self.launch_specification = CompactLaunchSpecification(connection)
+            return self.launch_specification
+        elif name in self._skipped:
+            return _skip
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'spotInstanceRequestId':
+            self.id = value
+        elif name == 'spotPrice':
+            self.price = float(value)
+        elif name == 'type':
+            self.type = share(value)
+        elif name == 'state':
+            self.state = share(value)
+        elif name == 'createTime':
+            self.create_time = value
+        elif name == 'instanceId':
+            self.instance_id = value
+
+    def cancel(self):
+        self.connection.cancel_spot_instance_requests([self.id])
+
+def _size(obj, seen):
+    """
+    Estimate the memory held by obj and everything it refers to.
+    """
+    if id(obj) in seen or obj is None or isinstance(obj, (bool, int, float)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, basestring):
+        return size
+    if isinstance(obj, dict):
+        for (key, value) in obj.items():
+            size += _size(key, seen) + _size(value, seen)
+    elif isinstance(obj, list):
+        for value in obj:
+            size += _size(value, seen)
+    if hasattr(obj, '__dict__'):
+        size += _size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            size += _size(getattr(obj, slot, None), seen)
+    return size
+
+def _response(reservations):
+    """
+    Make a DescribeInstances response body like a busy account's.
+    """
+    item = """<item><reservationId>r-%(n)08x</reservationId>
+<ownerId>123456789012</ownerId>
+<groupSet><item><groupId>cs61c-%(n)d</groupId></item></groupSet>
+<instancesSet><item><instanceId>i-%(n)08x</instanceId>
+<imageId>ami-12345678</imageId>
+<instanceState><code>16</code><name>running</name></instanceState>
+<privateDnsName>ip-10-0-0-1.ec2.internal</privateDnsName>
+<dnsName>ec2-50-0-0-1.compute-1.amazonaws.com</dnsName>
+<reason/><keyName>cs61c-ab-%(n)d</keyName><amiLaunchIndex>0</amiLaunchIndex>
+<productCodes/><instanceType>c1.medium</instanceType>
+<launchTime>2012-03-01T12:00:00.000Z</launchTime>
+<placement><availabilityZone>us-east-1d</availabilityZone><groupName/>
+</placement><kernelId>aki-12345678</kernelId>
+<monitoring><state>disabled</state></monitoring>
+<privateIpAddress>10.0.0.1</privateIpAddress><ipAddress>50.0.0.1</ipAddress>
+<rootDeviceType>instance-store</rootDeviceType><blockDeviceMapping/>
+</item></instancesSet></item>"""
+    return ('<?xml version="1.0"?><DescribeInstancesResponse xmlns='
+            '"http://ec2.amazonaws.com/doc/2010-08-31/"><requestId>x</requestId>'
+            '<reservationSet>%s</reservationSet></DescribeInstancesResponse>' %
+            "".join([item % {'n': n} for n in range(reservations)]))
+
+def benchmark(reservations=5000, repeat=3):
+    """
+    Parse a synthetic DescribeInstances response with the full and the
+    compact classes, and print the time taken and memory held by each.
+    """
+    from boto.ec2.instance import Reservation
+    from boto.handler import XmlHandler
+    from boto.resultset import ResultSet
+    body = _response(reservations)
+    print "%d reservations, %d bytes of XML" % (reservations, len(body))
+    print "%-10s %10s %12s" % ("CLASSES", "SECONDS", "BYTES")
+    for (label, cls) in (("full", Reservation),
+                         ("compact", CompactReservation)):
+        best = None
+        for i in range(repeat):
+            rs = ResultSet([('item', cls)])
+            start_time = time.time()
+            xml.sax.parseString(body, XmlHandler(rs, None))
+            elapsed = time.time() - start_time
+            if best is None or elapsed < best:
+                best = elapsed
+        print "%-10s %10.3f %12d" % (label, best, _size(rs, set()))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark(int(sys.argv[1]))
+    else:
+        benchmark()
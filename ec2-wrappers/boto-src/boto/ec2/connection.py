@@ -48,6 +48,7 @@ from boto.ec2.spotdatafeedsubscription import SpotDatafeedSubscription
 from boto.ec2.bundleinstance import BundleInstanceTask
 from boto.ec2.placementgroup import PlacementGroup
 from boto.ec2.tag import Tag
+from boto.ec2.compact import CompactReservation, CompactSpotInstanceRequest
 from boto.exception import EC2ResponseError
 
 #boto.set_stream_logger('ec2')
@@ -395,7 +396,8 @@ class EC2Connection(AWSQueryConnection):
 
     # Instance methods
 
-    def get_all_instances(self, instance_ids=None, filters=None):
+    def get_all_instances(self, instance_ids=None, filters=None,
+                          compact=False, max_results=None, next_token=None):
         """
         Retrieve all the instances associated with your account.
 
@@ -412,16 +414,68 @@ class EC2Connection(AWSQueryConnection):
                         being performed.  Check the EC2 API guide
                         for details.
 
+        :type compact: bool
+        :param compact: If True, return the smaller, read-only
+                        :class:`boto.ec2.compact.CompactReservation`
+                        objects, which keep only the common fields.
+
+        :type max_results: int
+        :param max_results: Optional maximum number of results to return
+                            in one page.
+
+        :type next_token: string
+        :param next_token: If the results come in pages, the next_token
+                           of the ResultSet holding the previous page.
+                           See :mod:`boto.ec2.lister` to iterate over
+                           all the pages.
+
         :rtype: list
         :return: A list of  :class:`boto.ec2.instance.Reservation`
         """
+        params = self._instances_params(instance_ids, filters, max_results,
+                                        next_token)
+        if compact:
+            reservation_class = CompactReservation
+        else:
+            reservation_class = Reservation
+        return self.get_list('DescribeInstances', params,
+                             [('item', reservation_class)])
+
+    def iter_all_instances(self, instance_ids=None, filters=None,
+                           compact=False, max_results=None, next_token=None,
+                           rs=None):
+        """
+        Like get_all_instances, but returns a generator which yields each
+        reservation as soon as it has been read from the response.
+
+        :type rs: :class:`boto.resultset.ResultSet`
+        :param rs: Optional empty ResultSet which is given the response's
+                   next_token once the generator is exhausted.
+
+        :rtype: generator
+        :return: An iterator of :class:`boto.ec2.instance.Reservation`
+        """
+        params = self._instances_params(instance_ids, filters, max_results,
+                                        next_token)
+        if compact:
+            reservation_class = CompactReservation
+        else:
+            reservation_class = Reservation
+        return self.get_list_iter('DescribeInstances', params,
+                                  [('item', reservation_class)], rs=rs)
+
+    def _instances_params(self, instance_ids, filters, max_results,
+                          next_token):
         params = {}
         if instance_ids:
             self.build_list_params(params, instance_ids, 'InstanceId')
         if filters:
             self.build_filter_params(params, filters)
-        return self.get_list('DescribeInstances', params,
-                             [('item', Reservation)])
+        if max_results:
+            params['MaxResults'] = max_results
+        if next_token:
+            params['NextToken'] = next_token
+        return params
 
     def run_instances(self, image_id, min_count=1, max_count=1,
                       key_name=None, security_groups=None,
@@ -741,7 +795,8 @@ class EC2Connection(AWSQueryConnection):
     # Spot Instances
 
     def get_all_spot_instance_requests(self, request_ids=None,
-                                       filters=None):
+                                       filters=None, compact=False,
+                                       max_results=None, next_token=None):
         """
         Retrieve all the spot instances requests associated with your account.
         
@@ -758,6 +813,21 @@ class EC2Connection(AWSQueryConnection):
                         being performed.  Check the EC2 API guide
                         for details.
 
+        :type compact: bool
+        :param compact: If True, return the smaller, read-only
+                        :class:`boto.ec2.compact.CompactSpotInstanceRequest`
+                        objects, which keep only the common fields.
+
+        :type max_results: int
+        :param max_results: Optional maximum number of results to return
+                            in one page.
+
+        :type next_token: string
+        :param next_token: If the results come in pages, the next_token
+                           of the ResultSet holding the previous page.
+                           See :mod:`boto.ec2.lister` to iterate over
+                           all the pages.
+
         :rtype: list
         :return: A list of
                  :class:`boto.ec2.spotinstancerequest.SpotInstanceRequest`
@@ -767,8 +837,16 @@ class EC2Connection(AWSQueryConnection):
             self.build_list_params(params, request_ids, 'SpotInstanceRequestId')
         if filters:
             self.build_filter_params(params, filters)
+        if max_results:
+            params['MaxResults'] = max_results
+        if next_token:
+            params['NextToken'] = next_token
+        if compact:
+            request_class = CompactSpotInstanceRequest
+        else:
+            request_class = SpotInstanceRequest
         return self.get_list('DescribeSpotInstanceRequests', params,
-                             [('item', SpotInstanceRequest)])
+                             [('item', request_class)])
 
     def get_spot_price_history(self, start_time=None, end_time=None,
                                instance_type=None, product_description=None):
@@ -0,0 +1,108 @@
+# Copyright (c) 2006,2007 Mitch Garnaat http://garnaat.org/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, 
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+"""
+Generators for listing all the instances and spot instance requests in an
+account, which request further pages of results as they are needed, so
+only one page is held in memory at a time.
+"""
+
+from boto.resultset import ResultSet
+
+def reservation_lister(connection, instance_ids=None, filters=None,
+                       max_results=None, compact=False):
+    """
+    A generator function for listing reservations.  Each page is streamed
+    from the response as it is read.
+    """
+    next_token = None
+    while True:
+        rs = ResultSet()
+        for reservation in connection.iter_all_instances(
+                instance_ids=instance_ids, filters=filters, compact=compact,
+                max_results=max_results, next_token=next_token, rs=rs):
+            yield reservation
+        next_token = rs.next_token
+        if not next_token:
+            break
+
+class ReservationListResultSet:
+    """
+    A resultset for listing reservations.  Uses the reservation_lister
+    generator function and implements the iterator interface.  This
+    transparently handles the results paging from EC2, so even in an
+    account with many thousands of instances you can iterate over them
+    all without holding every reservation at once.
+    """
+
+    def __init__(self, connection=None, instance_ids=None, filters=None,
+                 max_results=None, compact=False):
+        self.connection = connection
+        self.instance_ids = instance_ids
+        self.filters = filters
+        self.max_results = max_results
+        self.compact = compact
+
+    def __iter__(self):
+        return reservation_lister(self.connection,
+                                  instance_ids=self.instance_ids,
+                                  filters=self.filters,
+                                  max_results=self.max_results,
+                                  compact=self.compact)
+
+def spot_request_lister(connection, request_ids=None, filters=None,
+                        max_results=None, compact=False):
+    """
+    A generator function for listing spot instance requests.
+    """
+    next_token = None
+    while True:
+        rs = connection.get_all_spot_instance_requests(
+            request_ids=request_ids, filters=filters, compact=compact,
+            max_results=max_results, next_token=next_token)
+        for request in rs:
+            yield request
+        next_token = rs.next_token
+        if not next_token:
+            break
+
+class SpotRequestListResultSet:
+    """
+    A resultset for listing spot instance requests.  Uses the
+    spot_request_lister generator function and implements the iterator
+    interface, transparently handling the results paging from EC2.
+    """
+
+    def __init__(self, connection=None, request_ids=None, filters=None,
+                 max_results=None, compact=False):
+        self.connection = connection
+        self.request_ids = request_ids
+        self.filters = filters
+        self.max_results = max_results
+        self.compact = compact
+
+    def __iter__(self):
+        return spot_request_lister(self.connection,
+                                   request_ids=self.request_ids,
+                                   filters=self.filters,
+                                   max_results=self.max_results,
+                                   compact=self.compact)
@@ -26,21 +26,23 @@ class XmlHandler(xml.sax.ContentHandler):
     def __init__(self, root_node, connection):
         self.connection = connection
         self.nodes = [('root', root_node)]
-        self.current_text = ''
+        # Text arrives in many small pieces, so collect them and join once.
+        self.current_text = []
 
     def startElement(self, name, attrs):
-        self.current_text = ''
+        self.current_text = []
         new_node = self.nodes[-1][1].startElement(name, attrs, self.connection)
         if new_node != None:
             self.nodes.append((name, new_node))
 
     def endElement(self, name):
-        self.nodes[-1][1].endElement(name, self.current_text, self.connection)
+        self.nodes[-1][1].endElement(name, ''.join(self.current_text),
+                                     self.connection)
         if self.nodes[-1][0] == name:
             self.nodes.pop()
-        self.current_text = ''
+        self.current_text = []
 
     def characters(self, content):
-        self.current_text += content
+        self.current_text.append(content)
             
 
@@ -98,7 +98,7 @@ class ResultSet(list):
             self.status = self.to_boolean(value, 'Success')
         elif name == 'ItemName':
             self.append(value)
-        elif name == 'NextToken':
+        elif name == 'NextToken' or name == 'nextToken':
             self.next_token = value
         elif name == 'BoxUsage':
             try:
@@ -0,0 +1,27 @@
+#!/usr/bin/python
+# Builds a scratch usage database with record_usage.init_db() and exits
+# non-zero if any of record_usage.INDEXED_QUERIES would scan a whole table.
+import os
+import shutil
+import sys
+import tempfile
+
+import cs61cpaths
+
+tmpdir = tempfile.mkdtemp()
+try:
+    # record_usage opens USAGE_DB_FILE when it is imported
+    cs61cpaths.USAGE_DB_FILE = os.path.join(tmpdir, 'usage.db')
+    import record_usage
+
+    record_usage.init_db()
+    problems = record_usage.check_query_plans()
+    for (query, detail) in problems:
+        print "usage query not using an index (%s): %s" % (detail, query)
+    record_usage.dbh.close()
+finally:
+    shutil.rmtree(tmpdir, True)
+
+if problems:
+    sys.exit(1)
+print "%d usage queries checked" % len(record_usage.INDEXED_QUERIES)
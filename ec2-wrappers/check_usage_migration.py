@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# Upgrades a scratch usage database written by the version 0 record_usage
+# (ISO text stopped times, one open instance_stopped row per sweep) with
+# record_usage.init_db(), resumes and terminates the stopped instance, and
+# exits non-zero if the billed hours come out wrong.
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+
+import cs61cpaths
+
+class Instance(object):
+    def __init__(self, state, launch_time):
+        self.id = 'i-00000001'
+        self.instance_type = 'm1.small'
+        self.launch_time = launch_time
+        self.state = state
+        self.spot_instance_request_id = None
+        self.key_name = 'cs61c-ab-default'
+
+class Reservation(object):
+    def __init__(self, *instances):
+        self.instances = instances
+
+def hours_ago(hours):
+    return (datetime.datetime.utcnow() -
+            datetime.timedelta(hours=hours)).isoformat()
+
+tmpdir = tempfile.mkdtemp()
+try:
+    # record_usage opens USAGE_DB_FILE when it is imported
+    cs61cpaths.USAGE_DB_FILE = os.path.join(tmpdir, 'usage.db')
+    import record_usage
+    dbh = record_usage.dbh
+
+    # The version 0 tables, with an instance launched ten hours ago that was
+    # stopped eight hours ago and seen stopped by three sweeps since.
+    dbh.executescript("""
+        CREATE TABLE instances (
+            instance_id TEXT PRIMARY KEY,
+            instance_type TEXT NOT NULL,
+            start_time REAL,
+            end_time REAL DEFAULT NULL,
+            last_seen TEXT,
+            is_spot BOOLEAN,
+            username TEXT NOT NULL
+        );
+        CREATE TABLE instance_stopped (
+            instance_id TEXT REFERENCES instances,
+            stopped_time REAL,
+            running_time REAL DEFAULT NULL,
+            PRIMARY KEY(instance_id, stopped_time)
+        );
+        CREATE TABLE pending_spot_requests (
+            request_id TEXT PRIMARY KEY,
+            instance_type TEXT NOT NULL,
+            request_time REAL,
+            username TEXT NOT NULL
+        );
+    """)
+    launch_time = hours_ago(10)
+    dbh.execute("""
+        INSERT INTO instances (
+            instance_id, instance_type, start_time, last_seen, is_spot,
+            username
+        ) VALUES ('i-00000001', 'm1.small', julianday(?), julianday(?), 0,
+                  'cs61c-ab')
+    """, [launch_time, hours_ago(6)])
+    for hours in (8, 7, 6):
+        dbh.execute("""
+            INSERT INTO instance_stopped (instance_id, stopped_time)
+                VALUES ('i-00000001', ?)
+        """, [hours_ago(hours)])
+
+    record_usage.init_db()
+    record_usage.get_root_ec2_connection = lambda: None
+    for state in ('running', 'terminated'):
+        snapshot = [Reservation(Instance(state, launch_time))]
+        record_usage.reservation_lister = \
+            lambda ec2, filters=None, compact=False: snapshot
+        record_usage.update_instances()
+
+    # Two hours of running, plus the part hour since launch_time, bill as 3
+    problems = []
+    for (table, hours) in dbh.execute("""
+        SELECT 'finished_instance_times', hours FROM finished_instance_times
+        UNION ALL
+        SELECT 'user_cost_rollup', hours FROM user_cost_rollup
+    """).fetchall():
+        if hours != 3:
+            problems.append("%s has %s hours, not 3" % (table, hours))
+    dbh.close()
+finally:
+    shutil.rmtree(tmpdir, True)
+
+for problem in problems:
+    print "usage database upgrade: %s" % problem
+if problems:
+    sys.exit(1)
+print "usage database upgraded"
@@ -4,9 +4,10 @@ import subprocess
 import base64
 import os
 import pwd
-import re
+import time
 
-from boto.ec2.connection import EC2Connection
+from hadoop.cloud.cluster import TimeoutException
+from hadoop.cloud.util import backoff_delays
 
 EC2_RUNNER = '/home/ff/cs61c/bin/ec2-run'
 
@@ -17,19 +18,15 @@ class CS61CEc2Cluster(hadoop.cloud.providers.ec2.Ec2Cluster):
     """
 
     @staticmethod
-    def get_clusters_with_role(role, state="running"):
+    def _role_filters(roles, state):
         username = os.environ.get('FAKE_USERNAME')
         if username is None:
             username = pwd.getpwuid(os.getuid()).pw_name
-        all_instances = EC2Connection().get_all_instances()
-        clusters = []
-        for res in all_instances:
-          instance = res.instances[0]
-          if instance.key_name.startswith(username):
-            for group in res.groups:
-              if group.id.endswith("-" + role) and instance.state == state:
-                clusters.append(re.sub("-%s$" % re.escape(role), "", group.id))
-        return clusters
+        filters = hadoop.cloud.providers.ec2.Ec2Cluster._role_filters(roles,
+                                                                      state)
+        # only this user's instances
+        filters['key-name'] = "%s*" % (username)
+        return filters
 
     def __init__(self, name, config_dir):
         super(CS61CEc2Cluster, self).__init__(name, config_dir)
@@ -70,33 +67,36 @@ class CS61CEc2Cluster(hadoop.cloud.providers.ec2.Ec2Cluster):
         proc.stdin.close()
         result = simplejson.load(proc.stdout)
         proc.wait()
+        self.invalidate()
 
         if use_spot:
-            spot_instance_request_ids = [request in result]
-            instance_ids = wait_for_spot_instances(spot_instance_request_ids)
+            spot_instance_request_ids = list(result)
+            instance_ids = self.wait_for_spot_instances(spot_instance_request_ids)
             return instance_ids
         else:
             return [instance for instance in result]
 
 #http://tech.backtype.com/patching-the-cloudera-ec2-boot-scripts-for-sp
     def wait_for_spot_instances(self, request_ids, timeout=1200):
-        start_time = time.time()
-        while True:
-          if (time.time() - start_time >= timeout):
-            raise TimeoutException()
-          try:
-            instance_ids = [request.instanceId for request in self.ec2Connection.get_all_spot_instance_requests(request_ids)]
-            if self._all_started(self.ec2Connection.get_all_instances(instance_ids)):
-              return instance_ids
-          except AttributeError:
-            pass
-          # don't timeout for race condition where instance is not yet registered
-          except EC2ResponseError:
-            pass
-          time.sleep(15)
+        deadline = time.time() + timeout
+        for delay in backoff_delays(5.0, 60.0):
+            requests = self.ec2Connection.get_all_spot_instance_requests(
+                filters={'spot-instance-request-id': request_ids},
+                compact=True)
+            instance_ids = [request.instance_id for request in requests
+                            if request.instance_id]
+            if len(instance_ids) == len(request_ids):
+                break
+            if time.time() + delay >= deadline:
+                raise TimeoutException()
+            time.sleep(delay)
+        self.wait_for_instances(instance_ids, deadline - time.time())
+        return instance_ids
 
     def _get_spot_requests(self, cluster):
-        requests = self.ec2Connection.get_all_spot_instance_requests()
+        # compact requests list their launch groups by name
+        requests = self.ec2Connection.get_all_spot_instance_requests(
+            compact=True)
         requests = filter(lambda x:cluster in x.launch_specification.groups, requests)
         return requests
 
@@ -106,5 +106,6 @@ class CS61CEc2Cluster(hadoop.cloud.providers.ec2.Ec2Cluster):
         instances = self._get_instances(self._get_cluster_group_name(), 'running')
         if instances:
             self.ec2Connection.terminate_instances([i.id for i in instances])
+            self.invalidate()
 
 
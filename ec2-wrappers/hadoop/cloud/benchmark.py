@@ -0,0 +1,163 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Times cluster commands end to end with the EC2 provider, against a simulated
+EC2 region (see hadoop.cloud.providers.fakeec2) which models API latency,
+instance boot time and eventual consistency, and counts the API calls each
+command makes. Run with "python -m hadoop.cloud.benchmark --help" for the
+options.
+"""
+
+from optparse import OptionParser
+from hadoop.cloud.cluster import CLUSTER_PROVIDER_MAP
+from hadoop.cloud.providers.fakeec2 import FakeEc2
+from hadoop.cloud.providers.fakeec2 import FakeEc2Cluster
+from hadoop.cloud.service import DATANODE
+from hadoop.cloud.service import HadoopService
+from hadoop.cloud.service import InstanceTemplate
+from hadoop.cloud.service import JOBTRACKER
+from hadoop.cloud.service import NAMENODE
+from hadoop.cloud.service import SECONDARY_NAMENODE
+from hadoop.cloud.service import TASKTRACKER
+import gzip
+import os
+import re
+import shlex
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+class BenchmarkHadoopService(HadoopService):
+  """
+  A HadoopService which doesn't wait for the daemons, since nothing runs on
+  simulated instances, and which can be made to launch the slaves after the
+  master rather than alongside it.
+  """
+
+  lookup_urls = True
+
+  def _get_singleton_lookup_urls(self, instance_templates):
+    if not self.lookup_urls:
+      return None
+    return super(BenchmarkHadoopService, self)._get_singleton_lookup_urls(
+      instance_templates)
+
+  def _wait_for_hadoop(self, number, timeout=600):
+    pass
+
+def time_command(cloud, function, *args):
+  """
+  Call function, hiding its output.
+  @return: (elapsed seconds, dict of API calls made by action)
+  """
+  cloud.api_calls.clear()
+  stdout = sys.stdout
+  sys.stdout = StringIO.StringIO()
+  start_time = time.time()
+  try:
+    function(*args)
+  finally:
+    elapsed = time.time() - start_time
+    sys.stdout = stdout
+  return (elapsed, dict(cloud.api_calls))
+
+def check_lookup_url(cloud, cluster):
+  """
+  Fetch the namenode lookup URL from a slave's user data, as the slave would
+  at boot, and check that it finds the namenode.
+  @return: True if it does
+  """
+  slave = cluster.get_instances_in_role(DATANODE, "running")[0]
+  user_data = gzip.GzipFile(
+    fileobj=StringIO.StringIO(cloud.user_data(slave.id))).read()
+  env = {}
+  for line in user_data.splitlines():
+    if line.startswith("export "):
+      for assignment in shlex.split(line)[1:]:
+        (name, value) = assignment.split("=", 1)
+        env[name] = value
+  if "NN_HOST_URL" not in env:
+    print "No NN_HOST_URL in the user data of %s" % slave.id
+    return False
+  match = re.search("<dnsName>([^<]*)", cloud.fetch(env["NN_HOST_URL"]))
+  namenode = cluster.get_instances_in_role(NAMENODE, "running")[0]
+  found = match and match.group(1) or None
+  print "NN_HOST_URL found %s; the namenode is %s" % (found,
+                                                      namenode.public_ip)
+  return found == namenode.public_ip
+
+def main():
+  parser = OptionParser()
+  parser.add_option("--slaves", type="int", default=10,
+    help="The number of slave instances to launch.")
+  parser.add_option("--latency", type="float", default=0.1,
+    help="Seconds taken by each API call.")
+  parser.add_option("--boot-time", type="float", default=10,
+    help="Seconds taken by each instance to start running.")
+  parser.add_option("--consistency-delay", type="float", default=1,
+    help="Seconds before a new instance appears in listings.")
+  parser.add_option("--no-lookup-urls", action="store_true", default=False,
+    help="Launch the slaves after the master rather than alongside it.")
+  parser.add_option("--user-data-file", metavar="URL",
+    default=os.path.join(os.path.dirname(__file__), 'data',
+                         'hadoop-ec2-init-remote.sh'),
+    help="The user data template to launch with.")
+  (options, args) = parser.parse_args()
+
+  cloud = FakeEc2(latency=options.latency, boot_time=options.boot_time,
+                  consistency_delay=options.consistency_delay)
+  FakeEc2Cluster.cloud = cloud
+  # Only for this process, so that list-all can find the simulated region
+  CLUSTER_PROVIDER_MAP["fake-ec2"] = ('hadoop.cloud.providers.fakeec2',
+                                      'FakeEc2Cluster')
+  os.environ.setdefault('AWS_ACCESS_KEY_ID', cloud.access_key)
+  os.environ.setdefault('AWS_SECRET_ACCESS_KEY', cloud.secret_key)
+
+  config_dir = tempfile.mkdtemp()
+  try:
+    cluster = FakeEc2Cluster("benchmark", config_dir)
+    service = BenchmarkHadoopService(cluster)
+    service.lookup_urls = not options.no_lookup_urls
+    def template(roles, number):
+      return InstanceTemplate(roles, number, "ami-12345678", "m1.small",
+                              "benchmark-key", "benchmark.pub",
+                              "benchmark.pem", options.user_data_file)
+    templates = (template((NAMENODE, SECONDARY_NAMENODE, JOBTRACKER), 1),
+                 template((DATANODE, TASKTRACKER), options.slaves))
+    print "%-18s %8s %6s  %s" % ("COMMAND", "SECONDS", "CALLS", "BY ACTION")
+    def run(name, function, *args):
+      # Each command is a new process, with nothing cached from the last
+      cluster.invalidate()
+      (elapsed, api_calls) = time_command(cloud, function, *args)
+      print "%-18s %8.2f %6d  %s" % (name, elapsed,
+        sum(api_calls.values()),
+        ", ".join(["%s=%d" % item for item in sorted(api_calls.items())]))
+    run("launch-cluster", service.launch_cluster, templates, config_dir,
+        ["10.0.0.0/8"])
+    lookup_ok = not service.lookup_urls or check_lookup_url(cloud, cluster)
+    run("list-all", service.list_all, "fake-ec2")
+    run("list", service.list)
+    run("terminate-cluster", service.terminate_cluster, True)
+    run("delete-cluster", service.delete_cluster)
+  finally:
+    shutil.rmtree(config_dir, True)
+  if not lookup_ok:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
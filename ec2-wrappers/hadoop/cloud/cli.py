@@ -16,7 +16,9 @@
 from __future__ import with_statement
 
 import ConfigParser
+import getpass
 from hadoop.cloud import VERSION
+from hadoop.cloud import tracing
 from hadoop.cloud.cluster import get_cluster
 from hadoop.cloud.service import get_service
 from hadoop.cloud.service import InstanceTemplate
@@ -143,7 +145,7 @@ where COMMAND and [OPTIONS] may be one of:
   launch-cluster CLUSTER (NUM_SLAVES| launch a master and NUM_SLAVES slaves or
     N ROLE [N ROLE ...])                N instances in ROLE in CLUSTER
   create-formatted-snapshot CLUSTER   create an empty, formatted snapshot of
-    SIZE                                size SIZE GiB
+    SIZE[,SIZE...]                      size SIZE GiB, for each SIZE
   list-storage CLUSTER                list storage volumes for CLUSTER
   create-storage CLUSTER ROLE         create volumes for NUM_INSTANCES instances
     NUM_INSTANCES SPEC_FILE             in ROLE for CLUSTER, using SPEC_FILE
@@ -271,6 +273,15 @@ def get_image_id(cluster, options):
     return options.get('image_id')
 
 def main():
+  # Use HADOOP_CLOUD_TRACE_FILE=<file> to append the time taken by each phase
+  # of the command to <file>.
+  if len(sys.argv) >= 2 and os.getenv("HADOOP_CLOUD_TRACE_FILE"):
+    tracing.enable(os.getenv("HADOOP_CLOUD_TRACE_FILE"), command=sys.argv[1],
+                   args=sys.argv[2:], user=getpass.getuser(), version=VERSION)
+  with tracing.phase(len(sys.argv) >= 2 and sys.argv[1] or "usage"):
+    _main()
+
+def _main():
   # Use HADOOP_CLOUD_LOGGING_LEVEL=DEBUG to enable debugging output.
   logging.basicConfig(level=getattr(logging,
                                     os.getenv("HADOOP_CLOUD_LOGGING_LEVEL",
@@ -398,7 +409,7 @@ def main():
   elif command == 'create-formatted-snapshot':
     (opt, args, service) = parse_options_and_config(command, SNAPSHOT_OPTIONS,
                                                     ("SIZE",))
-    size = int(args[1])
+    size = [int(s) for s in args[1].split(",")]
     check_options_set(opt, ['availability_zone', 'key_name'])
     ami_ubuntu_intrepid_x86 = 'ami-ec48af85' # use a general AMI
     service.create_formatted_snapshot(size,
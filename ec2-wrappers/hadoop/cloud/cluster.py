@@ -20,11 +20,20 @@ Classes for controlling a cluster of cloud instances.
 from __future__ import with_statement
 
 import gzip
+import hashlib
+import logging
+import os
+import re
 import StringIO
+import tempfile
 import urllib
+import urllib2
+import urlparse
 
 from hadoop.cloud.storage import Storage
 
+logger = logging.getLogger(__name__)
+
 CLUSTER_PROVIDER_MAP = {
   "dummy": ('hadoop.cloud.providers.dummy', 'DummyCluster'),
   "ec2": ('hadoop.cloud.providers.ec2', 'Ec2Cluster'),
@@ -50,6 +59,27 @@ class Cluster(object):
     self.name = name
     self.config_dir = config_dir
 
+  @classmethod
+  def get_clusters_with_role(cls, role, state="running"):
+    """
+    Return the names of the clusters with instances in a role, in the given
+    state.
+    """
+    raise Exception("Unimplemented")
+
+  @classmethod
+  def get_clusters_with_roles(cls, roles, state="running"):
+    """
+    Return the names of the clusters with instances in any of the given roles,
+    in the given state.
+    """
+    clusters = []
+    for role in roles:
+      for cluster in cls.get_clusters_with_role(role, state):
+        if cluster not in clusters:
+          clusters.append(cluster)
+    return clusters
+
   def get_provider_code(self):
     """
     The code that uniquely identifies the cloud provider.
@@ -62,6 +92,15 @@ class Cluster(object):
     """
     pass
 
+  def authorize_roles(self, rules):
+    """
+    Authorize access to machines in roles from networks.
+
+    @param rules: a list of (role, from_port, to_port, cidr_ip) tuples
+    """
+    for (role, from_port, to_port, cidr_ip) in rules:
+      self.authorize_role(role, from_port, to_port, cidr_ip)
+
   def get_instances_in_role(self, role, state_filter=None):
     """
     Get all the instances in a role, filtered by state.
@@ -78,6 +117,14 @@ class Cluster(object):
     """
     pass
 
+  def get_role_lookup_url(self, role, expires_in=3600):
+    """
+    Return a URL that an instance can fetch at boot to find the address of the
+    running instance in a role, or None if the provider does not support it.
+    The URL need not work after expires_in seconds.
+    """
+    return None
+
   def check_running(self, role, number):
     """
     Check that a certain number of instances in a role are running.
@@ -124,41 +171,127 @@ class Cluster(object):
     """
     return Storage(self)
 
+# Templates read by this process, by filename, as (validator, digest,
+# contents). The validator is the modification time and size for local files,
+# and None for URLs, which are revalidated once per process.
+_templates = {}
+
+# Compressed user data, by template digest and replacements.
+_compressed = {}
+
 class InstanceUserData(object):
   """
   The data passed to an instance on start up.
+
+  Templates given as http or https URLs are kept in cache_dir, if given, named
+  by the SHA-1 of their contents, and are only downloaded again when the
+  server reports (by ETag or Last-Modified) that they have changed.
   """
 
-  def __init__(self, filename, replacements={}):
+  def __init__(self, filename, replacements={}, cache_dir=None):
     self.filename = filename
     self.replacements = replacements
+    self.cache_dir = cache_dir
 
   def _read_file(self, filename):
     """
     Read the user data.
     """
+    if urlparse.urlparse(filename)[0] in ('http', 'https') and self.cache_dir:
+      return self._read_url_with_cache(filename)
     return urllib.urlopen(filename).read()
 
+  def _read_url_with_cache(self, url):
+    url_digest = hashlib.sha1(url).hexdigest()
+    metadata_file = os.path.join(self.cache_dir, "url-%s" % url_digest)
+    (etag, last_modified, digest) = (None, None, None)
+    if os.path.exists(metadata_file):
+      (etag, last_modified, digest) = \
+        [line or None for line in open(metadata_file).read().split("\n")[:3]]
+      if not os.path.exists(os.path.join(self.cache_dir, digest)):
+        (etag, last_modified, digest) = (None, None, None)
+    request = urllib2.Request(url)
+    if etag:
+      request.add_header('If-None-Match', etag)
+    if last_modified:
+      request.add_header('If-Modified-Since', last_modified)
+    try:
+      response = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+      if e.code == 304 and digest:
+        logger.debug("Using cached copy of %s", url)
+        return open(os.path.join(self.cache_dir, digest)).read()
+      raise
+    except urllib2.URLError, e:
+      if not digest:
+        raise
+      logger.warn("Could not fetch %s (%s), using cached copy", url, e)
+      return open(os.path.join(self.cache_dir, digest)).read()
+    contents = response.read()
+    digest = hashlib.sha1(contents).hexdigest()
+    if not os.path.exists(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    self._write_atomically(os.path.join(self.cache_dir, digest), contents)
+    self._write_atomically(metadata_file, "%s\n%s\n%s\n" %
+                           (response.info().getheader('ETag') or '',
+                            response.info().getheader('Last-Modified') or '',
+                            digest))
+    return contents
+
+  def _write_atomically(self, filename, contents):
+    (fd, temp_filename) = tempfile.mkstemp(dir=os.path.dirname(filename))
+    f = os.fdopen(fd, "w")
+    try:
+      f.write(contents)
+    finally:
+      f.close()
+    os.rename(temp_filename, filename)
+
+  def _read_template(self):
+    """
+    Return (digest, contents) for the template, reading it at most once per
+    change.
+    """
+    try:
+      st = os.stat(self.filename)
+      validator = (st.st_mtime, st.st_size)
+    except OSError:
+      validator = None
+    cached = _templates.get(self.filename)
+    if cached and cached[0] == validator:
+      return cached[1:]
+    contents = self._read_file(self.filename)
+    digest = hashlib.sha1(contents).hexdigest()
+    _templates[self.filename] = (validator, digest, contents)
+    return (digest, contents)
+
   def read(self):
     """
     Read the user data, making replacements.
     """
-    contents = self._read_file(self.filename)
-    for (match, replacement) in self.replacements.iteritems():
-      if replacement == None:
-        replacement = ''
-      contents = contents.replace(match, replacement)
-    return contents
+    contents = self._read_template()[1]
+    if not self.replacements:
+      return contents
+    # Longest first, so that a placeholder which is a prefix of another one
+    # doesn't match in its place.
+    matches = sorted(self.replacements.keys(), key=len, reverse=True)
+    pattern = re.compile("|".join([re.escape(match) for match in matches]))
+    return pattern.sub(lambda m: self.replacements[m.group(0)] or '',
+                       contents)
 
   def read_as_gzip_stream(self):
     """
     Read and compress the data.
     """
-    output = StringIO.StringIO()
-    compressed = gzip.GzipFile(mode='wb', fileobj=output)
-    compressed.write(self.read())
-    compressed.close()
-    return output.getvalue()
+    key = (self._read_template()[0],
+           tuple(sorted(self.replacements.items())))
+    if key not in _compressed:
+      output = StringIO.StringIO()
+      compressed = gzip.GzipFile(mode='wb', fileobj=output)
+      compressed.write(self.read())
+      compressed.close()
+      _compressed[key] = output.getvalue()
+    return _compressed[key]
 
 class Instance(object):
   """
@@ -34,6 +34,34 @@ for role in $(echo "$ROLES" | tr "," "\n"); do
   esac
 done
 
+# Instances launched at the same time as the namenode/jobtracker are given
+# signed DescribeInstances URLs instead of their addresses; poll until the
+# instance is running and has a public hostname. The URLs expire at
+# HOST_LOOKUP_DEADLINE (seconds since the epoch), when the client has given
+# up on the launch too, so stop there rather than wait forever.
+function lookup_host() {
+  local host=
+  while [ -z "$host" ]; do
+    host=`wget -q -O - "$1" | grep -o '<dnsName>[^<]*' | head -1 | sed 's/<dnsName>//'`
+    if [ -z "$host" ]; then
+      if [ -n "$HOST_LOOKUP_DEADLINE" ] && \
+          [ `date +%s` -ge "$HOST_LOOKUP_DEADLINE" ]; then
+        echo "No running instance found at $1 before the deadline" >&2
+        return 1
+      fi
+      sleep 5
+    fi
+  done
+  echo $host
+}
+
+if [ -z "$NN_HOST" -a -n "$NN_HOST_URL" ]; then
+  NN_HOST=`lookup_host "$NN_HOST_URL"` || exit 1
+fi
+if [ -z "$JT_HOST" -a -n "$JT_HOST_URL" ]; then
+  JT_HOST=`lookup_host "$JT_HOST_URL"` || exit 1
+fi
+
 function register_auto_shutdown() {
   if [ ! -z "$AUTO_SHUTDOWN" ]; then
     shutdown -h +$AUTO_SHUTDOWN >/dev/null &
@@ -530,6 +558,17 @@ END
 
 }
 
+# Appends an event to the status file served by the web server set up by
+# setup_web; the client tails it while waiting for the cluster to start. Only
+# the namenode's machine runs the web server, so only the master daemons
+# (when they share that machine) are reported; the client learns about the
+# slaves from the jobtracker instead.
+function publish_status() {
+  if [ -n "$WWW_BASE" ]; then
+    echo "`date +%s` $SELF_HOST $1" >> $WWW_BASE/hadoop-status
+  fi
+}
+
 function start_namenode() {
   if which dpkg &> /dev/null; then
     AS_HADOOP="su -s /bin/bash - hadoop -c"
@@ -583,12 +622,15 @@ for role in $(echo "$ROLES" | tr "," "\n"); do
   nn)
     setup_web
     start_namenode
+    publish_status "nn started"
     ;;
   snn)
     start_daemon secondarynamenode
+    publish_status "snn started"
     ;;
   jt)
     start_daemon jobtracker
+    publish_status "jt started"
     ;;
   dn)
     start_daemon datanode
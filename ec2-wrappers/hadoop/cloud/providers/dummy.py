@@ -42,7 +42,7 @@ class DummyCluster(Cluster):
     logger.info("get_instances_in_role(%s, %s)", role, state_filter)
     return [Instance(1, '127.0.0.1', '127.0.0.1')]
 
-  def print_status(self, roles, state_filter="running"):
+  def print_status(self, roles=None, state_filter="running"):
     logger.info("print_status(%s, %s)", roles, state_filter)
 
   def launch_instances(self, role, number, image_id, size_id,
@@ -13,23 +13,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import with_statement
+
 from boto.ec2.connection import EC2Connection
+from boto.ec2.lister import reservation_lister
 from boto.exception import EC2ResponseError
 import logging
+from hadoop.cloud import tracing
 from hadoop.cloud.cluster import Cluster
 from hadoop.cloud.cluster import Instance
 from hadoop.cloud.cluster import RoleSyntaxException
 from hadoop.cloud.cluster import TimeoutException
+from hadoop.cloud.ssh import SshFanOut
 from hadoop.cloud.storage import JsonVolumeManager
 from hadoop.cloud.storage import JsonVolumeSpecManager
 from hadoop.cloud.storage import MountableVolume
+from hadoop.cloud.storage import SqliteVolumeManager
 from hadoop.cloud.storage import Storage
+from hadoop.cloud.util import backoff_delays
+from hadoop.cloud.util import run_in_parallel
 from hadoop.cloud.util import xstr
 import os
 import re
 import subprocess
 import sys
+import threading
 import time
+import urllib
 
 logger = logging.getLogger(__name__)
 
@@ -41,18 +51,185 @@ def _run_command_on_instance(instance, ssh_options, command):
                            shell=True)
   print "Command running on %s returned with value %s" % \
     (instance.public_dns_name, retcode)
+  return retcode
+
+def _index_instances(reservations):
+  """
+  Index instances by cluster and role, using their security groups: each
+  instance in a cluster is in a group named after the cluster, and in a
+  "<cluster>-<role>" group for each of its roles.
+  @return: a dict from cluster name to a dict from role to instances
+  """
+  index = {}
+  for res in reservations:
+    group_names = [group.id for group in res.groups]
+    for group_name in group_names:
+      (cluster, dash, role) = group_name.rpartition("-")
+      if dash and cluster in group_names:
+        index.setdefault(cluster, {}).setdefault(role, []) \
+          .extend(res.instances)
+  return index
+
+def _wait_for_volumes(ec2_connection, volume_ids, status='available',
+                      timeout=None):
+  """
+  Waits until all the given volumes have a status (e.g. 'available' or
+  'in-use'), polling them together with backoff.
+  Raises TimeoutException if a timeout is given and exceeded.
+  """
+  start_time = time.time()
+  for delay in backoff_delays(1.0, 15.0):
+    try:
+      volumes = ec2_connection.get_all_volumes(volume_ids)
+      if len([v for v in volumes if v.status != status]) == 0:
+        return volumes
+    # don't timeout for race condition where volume is not yet registered
+    except EC2ResponseError:
+      pass
+    if timeout != None and time.time() + delay - start_time >= timeout:
+      raise TimeoutException()
+    sys.stdout.write(".")
+    sys.stdout.flush()
+    time.sleep(delay)
 
 def _wait_for_volume(ec2_connection, volume_id):
   """
   Waits until a volume becomes available.
   """
-  while True:
-    volumes = ec2_connection.get_all_volumes([volume_id,])
-    if volumes[0].status == 'available':
-      break
+  _wait_for_volumes(ec2_connection, [volume_id,])
+
+def _wait_for_snapshots(ec2_connection, snapshot_ids, timeout=None):
+  """
+  Waits until none of the given snapshots is still pending, polling them
+  together with backoff.
+  Raises TimeoutException if a timeout is given and exceeded.
+  """
+  start_time = time.time()
+  for delay in backoff_delays(2.0, 30.0):
+    try:
+      snapshots = ec2_connection.get_all_snapshots(snapshot_ids)
+      if len([s for s in snapshots if s.status == 'pending']) == 0:
+        return snapshots
+    # don't timeout for race condition where snapshot is not yet registered
+    except EC2ResponseError:
+      pass
+    if timeout != None and time.time() + delay - start_time >= timeout:
+      raise TimeoutException()
     sys.stdout.write(".")
     sys.stdout.flush()
-    time.sleep(1)
+    time.sleep(delay)
+
+def _attach_volume(volume, instance_id, device, timeout=300):
+  """
+  Attaches a volume, retrying while EC2 does not yet consider the instance
+  able to take it (e.g. because it has only just started).
+  """
+  start_time = time.time()
+  for delay in backoff_delays(2.0, 15.0):
+    try:
+      return volume.attach(instance_id, device)
+    except EC2ResponseError, e:
+      if e.error_code not in ('IncorrectState', 'InvalidInstanceID.NotFound'):
+        raise
+      if time.time() + delay - start_time >= timeout:
+        raise
+    time.sleep(delay)
+
+class InstanceWaiter(object):
+  """
+  Waits for EC2 instances to reach a state. Any number of threads may wait at
+  once (e.g. one per cluster or role being launched); a single thread at a
+  time polls on behalf of all of them, with one DescribeInstances call
+  covering every instance anyone is waiting for.
+  """
+
+  def __init__(self, ec2_connection, initial_delay=2.0, max_delay=30.0,
+               factor=1.5):
+    self.ec2_connection = ec2_connection
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+    self.factor = factor
+    self._condition = threading.Condition()
+    self._waiters = {}   # instance id -> number of threads waiting for it
+    self._states = {}    # instance id -> last state seen
+    self._polling = False
+    self._delays = None
+
+  def _poll(self):
+    with self._condition:
+      instance_ids = self._waiters.keys()
+    # Filtering by instance-id, rather than asking for the ids directly,
+    # avoids an error for instances EC2 has not registered yet.
+    states = {}
+    for res in self.ec2_connection.get_all_instances(
+        filters={ 'instance-id': instance_ids }, compact=True):
+      for instance in res.instances:
+        states[instance.id] = instance.state
+    with self._condition:
+      self._states.update(states)
+
+  def wait(self, instance_ids, timeout=600, state="running",
+           on_ready=None):
+    """
+    Wait until all of instance_ids are in the given state. on_ready, if given,
+    is called with each instance id as soon as that instance gets there.
+    Raise TimeoutException if the timeout is exceeded.
+    """
+    deadline = time.time() + timeout
+    remaining = set(instance_ids)
+    with self._condition:
+      for instance_id in remaining:
+        self._waiters[instance_id] = self._waiters.get(instance_id, 0) + 1
+      # Start polling quickly again for newly launched instances
+      self._delays = None
+    try:
+      while True:
+        with self._condition:
+          for instance_id in list(remaining):
+            if self._states.get(instance_id) == state:
+              remaining.discard(instance_id)
+              if on_ready:
+                on_ready(instance_id)
+          if not remaining:
+            return
+          if time.time() >= deadline:
+            raise TimeoutException()
+          if self._polling:
+            # Another thread is polling for us; wait for its results
+            self._condition.wait(max(0, deadline - time.time()))
+            continue
+          self._polling = True
+          if self._delays is None:
+            self._delays = backoff_delays(self.initial_delay, self.max_delay,
+                                          self.factor)
+          delay = self._delays.next()
+        try:
+          time.sleep(max(0, min(delay, deadline - time.time())))
+          try:
+            self._poll()
+          except EC2ResponseError:
+            pass
+        finally:
+          with self._condition:
+            self._polling = False
+            self._condition.notifyAll()
+    finally:
+      with self._condition:
+        for instance_id in instance_ids:
+          self._waiters[instance_id] -= 1
+          if self._waiters[instance_id] == 0:
+            del self._waiters[instance_id]
+            self._states.pop(instance_id, None)
+
+_instance_waiter = None
+def get_instance_waiter(ec2_connection):
+  """
+  Return the InstanceWaiter shared by all the clusters in this process.
+  """
+  global _instance_waiter
+  if _instance_waiter is None:
+    _instance_waiter = InstanceWaiter(ec2_connection)
+  return _instance_waiter
 
 class Ec2Cluster(Cluster):
   """
@@ -63,20 +240,53 @@ class Ec2Cluster(Cluster):
   to show a "foo" instance.
   """
 
+  @classmethod
+  def _connect(cls):
+    """
+    Return a new connection to EC2.
+    """
+    return EC2Connection()
+
   @staticmethod
-  def get_clusters_with_role(role, state="running"):
-    all_instances = EC2Connection().get_all_instances()
-    clusters = []
-    for res in all_instances:
-      instance = res.instances[0]
-      for group in res.groups:
-        if group.id.endswith("-" + role) and instance.state == state:
-          clusters.append(re.sub("-%s$" % re.escape(role), "", group.id))
-    return clusters
+  def _role_filters(roles, state):
+    """
+    Return the DescribeInstances filters selecting instances in any cluster's
+    group for any of the given roles, in the given state.
+    """
+    return { 'group-name': ["*-%s" % role for role in roles],
+             'instance-state-name': state }
+
+  @classmethod
+  def get_clusters_with_role(cls, role, state="running"):
+    return cls.get_clusters_with_roles([role], state)
+
+  @classmethod
+  def get_clusters_with_roles(cls, roles, state="running"):
+    """
+    Return the names of the clusters with instances in any of the given roles,
+    in the given state, using a single DescribeInstances call.
+    """
+    index = _index_instances(reservation_lister(cls._connect(),
+      filters=cls._role_filters(roles, state), compact=True))
+    return sorted([cluster for (cluster, instances_by_role) in index.items()
+                   if [role for role in roles if role in instances_by_role]])
 
   def __init__(self, name, config_dir):
     super(Ec2Cluster, self).__init__(name, config_dir)
-    self.ec2Connection = EC2Connection()
+    self.ec2Connection = self._connect()
+    self._instances_snapshot = None
+    self._roles_snapshot = None
+    self._group_names_snapshot = None
+
+  def invalidate(self):
+    """
+    Discard the snapshot of the cluster's instances and of the security group
+    names, so that the next lookup describes them again. Must be called
+    whenever instances are launched, change state or are terminated.
+    """
+    self._instances_snapshot = None
+    self._roles_snapshot = None
+    self._group_names_snapshot = None
 
   def get_provider_code(self):
     return "ec2"
@@ -102,10 +312,11 @@ class Ec2Cluster(Cluster):
     return group_names
 
   def _get_all_group_names(self):
-    security_groups = self.ec2Connection.get_all_security_groups()
-    security_group_names = \
-      [security_group.name for security_group in security_groups]
-    return security_group_names
+    if self._group_names_snapshot is None:
+      security_groups = self.ec2Connection.get_all_security_groups()
+      self._group_names_snapshot = \
+        [security_group.name for security_group in security_groups]
+    return self._group_names_snapshot
 
   def _get_all_group_names_for_cluster(self):
     all_group_names = self._get_all_group_names()
@@ -129,6 +340,7 @@ class Ec2Cluster(Cluster):
     if not cluster_group_name in security_group_names:
       self.ec2Connection.create_security_group(cluster_group_name,
                                                "Cluster (%s)" % (self.name))
+      security_group_names.append(cluster_group_name)
       self.ec2Connection.authorize_security_group(cluster_group_name,
                                                   cluster_group_name)
       # Allow SSH from anywhere
@@ -141,23 +353,103 @@ class Ec2Cluster(Cluster):
     if not role_group_name in security_group_names:
       self.ec2Connection.create_security_group(role_group_name,
         "Role %s (%s)" % (role, self.name))
+      security_group_names.append(role_group_name)
 
   def authorize_role(self, role, from_port, to_port, cidr_ip):
     """
     Authorize access to machines in a given role from a given network.
     """
-    self._check_role_name(role)
-    role_group_name = self._group_name_for_role(role)
-    # Revoke first to avoid InvalidPermission.Duplicate error
-    self.ec2Connection.revoke_security_group(role_group_name,
-                                             ip_protocol="tcp",
-                                             from_port=from_port,
-                                             to_port=to_port, cidr_ip=cidr_ip)
-    self.ec2Connection.authorize_security_group(role_group_name,
-                                                ip_protocol="tcp",
-                                                from_port=from_port,
-                                                to_port=to_port,
-                                                cidr_ip=cidr_ip)
+    self.authorize_roles([(role, from_port, to_port, cidr_ip)])
+
+  def authorize_roles(self, rules):
+    """
+    Authorize access to machines in roles from networks. The groups' current
+    rules are read in one call, and only the missing rules are added, with
+    one call per group.
+
+    @param rules: a list of (role, from_port, to_port, cidr_ip) tuples
+    """
+    missing = {} # group name -> (from_port, to_port) -> [cidr_ip]
+    for (role, from_port, to_port, cidr_ip) in rules:
+      self._check_role_name(role)
+      cidr_ips = missing.setdefault(self._group_name_for_role(role), {}) \
+        .setdefault((int(from_port), int(to_port)), [])
+      if cidr_ip not in cidr_ips:
+        cidr_ips.append(cidr_ip)
+    if not missing:
+      return
+    for group in self.ec2Connection.get_all_security_groups(missing.keys()):
+      for rule in group.rules:
+        if rule.ip_protocol != "tcp" or rule.from_port is None:
+          continue
+        cidr_ips = missing[group.name].get((int(rule.from_port),
+                                            int(rule.to_port)), [])
+        for grant in rule.grants:
+          if grant.cidr_ip in cidr_ips:
+            cidr_ips.remove(grant.cidr_ip)
+    for (group_name, permissions) in missing.items():
+      self._authorize_group(group_name, [(from_port, to_port, cidr_ips)
+        for ((from_port, to_port), cidr_ips) in sorted(permissions.items())
+        if cidr_ips])
+
+  def _authorize_group(self, group_name, permissions):
+    """
+    Add tcp rules to a security group in a single call.
+
+    @param permissions: a list of (from_port, to_port, [cidr_ip]) tuples
+    """
+    if not permissions:
+      return
+    params = { 'GroupName': group_name }
+    for (i, (from_port, to_port, cidr_ips)) in enumerate(permissions):
+      prefix = 'IpPermissions.%d.' % (i + 1)
+      params[prefix + 'IpProtocol'] = 'tcp'
+      params[prefix + 'FromPort'] = from_port
+      params[prefix + 'ToPort'] = to_port
+      for (j, cidr_ip) in enumerate(cidr_ips):
+        params[prefix + 'IpRanges.%d.CidrIp' % (j + 1)] = cidr_ip
+    try:
+      self.ec2Connection.get_status('AuthorizeSecurityGroupIngress', params)
+    except EC2ResponseError, e:
+      if e.error_code != 'InvalidPermission.Duplicate':
+        raise
+      # Someone else added one of the rules since we looked; add the rest
+      # one at a time.
+      for (from_port, to_port, cidr_ips) in permissions:
+        for cidr_ip in cidr_ips:
+          try:
+            self.ec2Connection.authorize_security_group(group_name,
+              ip_protocol="tcp", from_port=from_port, to_port=to_port,
+              cidr_ip=cidr_ip)
+          except EC2ResponseError, e:
+            if e.error_code != 'InvalidPermission.Duplicate':
+              raise
+
+  def _get_cluster_instances(self):
+    """
+    Return (group names, instance) for every instance in the cluster, from a
+    snapshot taken on first use and kept until invalidate() is called.
+    """
+    if self._instances_snapshot is None:
+      all_instances = self.ec2Connection.get_all_instances(
+        filters={ 'group-name': self._get_cluster_group_name() },
+        compact=True)
+      self._instances_snapshot = []
+      for res in all_instances:
+        group_names = [group.id for group in res.groups]
+        for instance in res.instances:
+          self._instances_snapshot.append((group_names, instance))
+      self._roles_snapshot = \
+        _index_instances(all_instances).get(self.name, {})
+    return self._instances_snapshot
+
+  def _get_role_instances(self, role, state_filter=None):
+    """
+    Get all the instances in a role, filtered by state, from the snapshot.
+    """
+    self._get_cluster_instances()
+    return [instance for instance in self._roles_snapshot.get(role, [])
+            if state_filter == None or instance.state == state_filter]
 
   def _get_instances(self, group_name, state_filter=None):
     """
@@ -167,14 +459,11 @@ class Ec2Cluster(Cluster):
     @param state_filter: the state that the instance should be in
       (e.g. "running"), or None for all states
     """
-    all_instances = self.ec2Connection.get_all_instances()
     instances = []
-    for res in all_instances:
-      for group in res.groups:
-        if group.id == group_name:
-          for instance in res.instances:
-            if state_filter == None or instance.state == state_filter:
-              instances.append(instance)
+    for (group_names, instance) in self._get_cluster_instances():
+      if group_name in group_names:
+        if state_filter == None or instance.state == state_filter:
+          instances.append(instance)
     return instances
 
   def get_instances_in_role(self, role, state_filter=None):
@@ -187,12 +476,36 @@ class Ec2Cluster(Cluster):
     """
     self._check_role_name(role)
     instances = []
-    for instance in self._get_instances(self._group_name_for_role(role),
-                                        state_filter):
+    for instance in self._get_role_instances(role, state_filter):
       instances.append(Instance(instance.id, instance.dns_name,
                                 instance.private_dns_name))
     return instances
 
+  def get_role_lookup_url(self, role, expires_in=3600):
+    """
+    Return a pre-signed DescribeInstances URL, valid for expires_in seconds,
+    listing the running instances in a role. The <dnsName> of the result is
+    the instance's public address.
+    """
+    conn = self.ec2Connection
+    params = {
+      'Action': 'DescribeInstances',
+      'Version': conn.APIVersion,
+      'AWSAccessKeyId': conn.aws_access_key_id,
+      'SignatureVersion': conn._auth_handler.SignatureVersion,
+      'Expires': time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                               time.gmtime(time.time() + expires_in)),
+    }
+    conn.build_filter_params(params, {
+      'group-name': self._group_name_for_role(role),
+      'instance-state-name': 'running',
+    })
+    path = conn.get_path('/')
+    (qs, signature) = conn._auth_handler._calc_signature(params, 'GET', path,
+                                                         conn.server_name())
+    return "%s://%s%s?%s&Signature=%s" % (conn.protocol, conn.host, path, qs,
+                                          urllib.quote(signature))
+
   def _print_instance(self, role, instance):
     print "\t".join((role, instance.id,
       instance.image_id,
@@ -210,39 +523,35 @@ class Ec2Cluster(Cluster):
         self._print_instance("", instance)
     else:
       for role in roles:
-        for instance in self._get_instances(self._group_name_for_role(role),
-                                            state_filter):
+        for instance in self._get_role_instances(role, state_filter):
           self._print_instance(role, instance)
 
   def launch_instances(self, roles, number, image_id, size_id,
                        instance_user_data, **kwargs):
-    for role in roles:
-      self._check_role_name(role)  
-      self._create_groups(role)
+    with tracing.phase("create_groups"):
+      for role in roles:
+        self._check_role_name(role)  
+        self._create_groups(role)
       
     user_data = instance_user_data.read_as_gzip_stream()
     security_groups = self._get_group_names(roles) + kwargs.get('security_groups', [])
 
-    reservation = self.ec2Connection.run_instances(image_id, min_count=number,
-      max_count=number, key_name=kwargs.get('key_name', None),
-      security_groups=security_groups, user_data=user_data,
-      instance_type=size_id, placement=kwargs.get('placement', None))
+    with tracing.phase("run_instances"):
+      reservation = self.ec2Connection.run_instances(image_id,
+        min_count=number, max_count=number,
+        key_name=kwargs.get('key_name', None),
+        security_groups=security_groups, user_data=user_data,
+        instance_type=size_id, placement=kwargs.get('placement', None))
+    self.invalidate()
     return [instance.id for instance in reservation.instances]
 
   def wait_for_instances(self, instance_ids, timeout=600):
-    start_time = time.time()
-    while True:
-      if (time.time() - start_time >= timeout):
-        raise TimeoutException()
-      try:
-        if self._all_started(self.ec2Connection.get_all_instances(instance_ids)):
-          break
-      # don't timeout for race condition where instance is not yet registered
-      except EC2ResponseError:
-        pass
+    def on_ready(instance_id):
       sys.stdout.write(".")
       sys.stdout.flush()
-      time.sleep(1)
+    get_instance_waiter(self.ec2Connection).wait(instance_ids, timeout,
+                                                 on_ready=on_ready)
+    self.invalidate()
 
   def _all_started(self, reservations):
     for res in reservations:
@@ -255,6 +564,7 @@ class Ec2Cluster(Cluster):
     instances = self._get_instances(self._get_cluster_group_name(), "running")
     if instances:
       self.ec2Connection.terminate_instances([i.id for i in instances])
+      self.invalidate()
 
   def delete(self):
     """
@@ -264,6 +574,7 @@ class Ec2Cluster(Cluster):
     group_names = self._get_all_group_names_for_cluster()
     for group in group_names:
       self.ec2Connection.delete_security_group(group)
+    self.invalidate()
 
   def get_storage(self):
     """
@@ -277,91 +588,187 @@ class Ec2Storage(Storage):
   Storage volumes for an EC2 cluster. The storage is associated with a named
   cluster. Metadata for the storage volumes is kept in a JSON file on the client
   machine (in a file called "ec2-storage-<cluster-name>.json" in the
-  configuration directory).
+  configuration directory), or, if HADOOP_CLOUD_STORAGE=sqlite is set in the
+  environment, in an SQLite database shared by all clusters
+  ("ec2-storage.db" in the configuration directory).
   """
 
+  # Devices to attach the volumes being formatted for snapshots to.
+  SNAPSHOT_DEVICES = ['/dev/sd%s' % letter for letter in 'jklmnop']
+
   @staticmethod
   def create_formatted_snapshot(cluster, size, availability_zone, image_id,
                                 key_name, ssh_options):
     """
-    Creates a formatted snapshot of a given size. This saves having to format
-    volumes when they are first attached.
+    Creates formatted snapshots of one or more sizes. This saves having to
+    format volumes when they are first attached. All the volumes are formatted
+    at once on a single helper instance, and each step waits for the state EC2
+    (or the instance) reports, rather than for a fixed time.
+    @param size: the size of the snapshot in GiB, or a list of sizes
+    @return: a dict from each size to the id of its snapshot, or None if the
+    helper instance did not start
     """
+    if isinstance(size, (int, long)):
+      sizes = [size]
+    else:
+      sizes = list(size)
+    devices = Ec2Storage.SNAPSHOT_DEVICES[:len(sizes)]
+    if len(devices) < len(sizes):
+      raise ValueError("At most %s snapshots can be created at once." %
+                       len(Ec2Storage.SNAPSHOT_DEVICES))
     conn = cluster.ec2Connection
     print "Starting instance"
     reservation = conn.run_instances(image_id, key_name=key_name,
                                      placement=availability_zone)
     instance = reservation.instances[0]
+    volumes = []
+    formatted = False
     try:
-      cluster.wait_for_instances([instance.id,])
-      print "Started instance %s" % instance.id
-    except TimeoutException:
-      print "Timeout"
-      return
-    print
-    print "Waiting 60 seconds before attaching storage"
-    time.sleep(60)
-    # Re-populate instance object since it has more details filled in
-    instance.update()
-
-    print "Creating volume of size %s in %s" % (size, availability_zone)
-    volume = conn.create_volume(size, availability_zone)
-    print "Created volume %s" % volume
-    print "Attaching volume to %s" % instance.id
-    volume.attach(instance.id, '/dev/sdj')
-
-    _run_command_on_instance(instance, ssh_options, """
-      while true ; do
-        echo 'Waiting for /dev/sdj...';
-        if [ -e /dev/sdj ]; then break; fi;
-        sleep 1;
-      done;
-      mkfs.ext3 -F -m 0.5 /dev/sdj
-    """)
-
-    print "Detaching volume"
-    conn.detach_volume(volume.id, instance.id)
-    print "Creating snapshot"
-    snapshot = volume.create_snapshot()
-    print "Created snapshot %s" % snapshot.id
-    _wait_for_volume(conn, volume.id)
+      # The volumes don't need the instance, so create them while it boots.
+      for volume_size in sizes:
+        print "Creating volume of size %s in %s" % (volume_size,
+                                                    availability_zone)
+        volumes.append(conn.create_volume(volume_size, availability_zone))
+        print "Created volume %s" % volumes[-1]
+      volume_ids = [volume.id for volume in volumes]
+      try:
+        cluster.wait_for_instances([instance.id,])
+        print "Started instance %s" % instance.id
+      except TimeoutException:
+        print "Timeout"
+        _wait_for_volumes(conn, volume_ids)
+        for volume in volumes:
+          volume.delete()
+        volumes = []
+        return None
+      # Re-populate instance object since it has more details filled in
+      instance.update()
+
+      _wait_for_volumes(conn, volume_ids)
+      print "Attaching volumes to %s" % instance.id
+      def attach(volume_and_device):
+        (volume, device) = volume_and_device
+        _attach_volume(volume, instance.id, device)
+      Ec2Storage._check_results(run_in_parallel(attach,
+                                                zip(volumes, devices)))
+      _wait_for_volumes(conn, volume_ids, 'in-use')
+
+      print "Waiting for SSH on %s" % instance.public_dns_name
+      fan_out = SshFanOut(ssh_options)
+      try:
+        if fan_out.wait([instance.public_dns_name]):
+          raise TimeoutException()
+      finally:
+        fan_out.close()
+      def format_volume(device):
+        retcode = _run_command_on_instance(instance, ssh_options, """
+          while true ; do
+            echo "Waiting for %(device)s...";
+            if [ -e %(device)s ]; then break; fi;
+            sleep 1;
+          done;
+          mkfs.ext3 -F -m 0.5 %(device)s
+        """ % { 'device': device })
+        if retcode != 0:
+          raise Exception("Formatting %s failed" % device)
+      Ec2Storage._check_results(run_in_parallel(format_volume, devices))
+
+      print "Detaching volumes"
+      for volume in volumes:
+        conn.detach_volume(volume.id, instance.id)
+      _wait_for_volumes(conn, volume_ids)
+      formatted = True
+    finally:
+      # The snapshots are taken from the detached volumes, so the instance
+      # can go as soon as formatting is done.
+      print "Stopping instance"
+      terminated = conn.terminate_instances([instance.id,])
+      print "Stopped instance %s" % terminated
+      if volumes and not formatted:
+        print "Volumes left behind: %s" % \
+          " ".join([volume.id for volume in volumes])
+
+    print "Creating snapshots"
+    snapshots = [volume.create_snapshot() for volume in volumes]
+    print "Deleting volumes"
+    for volume in volumes:
+      volume.delete()
+    print "Deleted volumes"
+    print "Waiting for snapshots to complete"
+    _wait_for_snapshots(conn, [snapshot.id for snapshot in snapshots])
     print
-    print "Deleting volume"
-    volume.delete()
-    print "Deleted volume"
-    print "Stopping instance"
-    terminated = conn.terminate_instances([instance.id,])
-    print "Stopped instance %s" % terminated
+    snapshot_ids = {}
+    for (volume_size, snapshot) in zip(sizes, snapshots):
+      print "Created snapshot %s of size %s GiB" % (snapshot.id, volume_size)
+      snapshot_ids[volume_size] = snapshot.id
+    return snapshot_ids
+
+  @staticmethod
+  def _check_results(results):
+    """
+    Re-raise the first exception in results from run_in_parallel.
+    """
+    for (result, exception) in results:
+      if exception is not None:
+        raise exception
 
   def __init__(self, cluster):
     super(Ec2Storage, self).__init__(cluster)
     self.config_dir = cluster.config_dir
+    self._volume_manager = None
 
   def _get_storage_filename(self):
     return os.path.join(self.config_dir,
                         "ec2-storage-%s.json" % (self.cluster.name))
 
+  def _get_volume_manager(self):
+    if self._volume_manager is None:
+      json_volume_manager = JsonVolumeManager(self._get_storage_filename())
+      if os.environ.get("HADOOP_CLOUD_STORAGE") == "sqlite":
+        self._volume_manager = SqliteVolumeManager(
+          os.path.join(self.config_dir, "ec2-storage.db"), self.cluster.name)
+        self._volume_manager.import_json(json_volume_manager)
+      else:
+        self._volume_manager = json_volume_manager
+    return self._volume_manager
+
   def create(self, role, number_of_instances, availability_zone, spec_filename):
     spec_file = open(spec_filename, 'r')
     volume_spec_manager = JsonVolumeSpecManager(spec_file)
-    volume_manager = JsonVolumeManager(self._get_storage_filename())
-    for dummy in range(number_of_instances):
+    volume_manager = self._get_volume_manager()
+    volume_specs = volume_spec_manager.volume_specs_for_role(role)
+    def create_volume(spec):
+      logger.info("Creating volume of size %s in %s from snapshot %s" % \
+                  (spec.size, availability_zone, spec.snapshot_id))
+      return self.cluster.ec2Connection.create_volume(spec.size,
+                                                      availability_zone,
+                                                      spec.snapshot_id)
+    results = run_in_parallel(create_volume,
+                              volume_specs * number_of_instances)
+    # Only record instances whose volumes were all created
+    error = None
+    for i in range(number_of_instances):
+      instance_results = results[i * len(volume_specs):
+                                 (i + 1) * len(volume_specs)]
       mountable_volumes = []
-      volume_specs = volume_spec_manager.volume_specs_for_role(role)
-      for spec in volume_specs:
-        logger.info("Creating volume of size %s in %s from snapshot %s" % \
-                    (spec.size, availability_zone, spec.snapshot_id))
-        volume = self.cluster.ec2Connection.create_volume(spec.size,
-                                                          availability_zone,
-                                                          spec.snapshot_id)
-        mountable_volumes.append(MountableVolume(volume.id, spec.mount_point,
-                                                 spec.device))
-      volume_manager.add_instance_storage_for_role(role, mountable_volumes)
+      for (spec, (volume, e)) in zip(volume_specs, instance_results):
+        if e != None:
+          error = e
+        else:
+          mountable_volumes.append(MountableVolume(volume.id,
+                                                   spec.mount_point,
+                                                   spec.device))
+      if len(mountable_volumes) == len(volume_specs):
+        volume_manager.add_instance_storage_for_role(role, mountable_volumes)
+      elif mountable_volumes:
+        logger.error("Not recording incomplete storage for an instance; "
+                     "volumes %s must be deleted by hand.",
+                     ", ".join([mv.volume_id for mv in mountable_volumes]))
+    if error != None:
+      raise error
 
   def _get_mountable_volumes(self, role):
-    storage_filename = self._get_storage_filename()
-    volume_manager = JsonVolumeManager(storage_filename)
-    return volume_manager.get_instance_storage_for_role(role)
+    return self._get_volume_manager().get_instance_storage_for_role(role)
 
   def get_mappings_string_for_role(self, role):
     mappings = {}
@@ -382,9 +789,7 @@ class Ec2Storage(Storage):
     return False
 
   def get_roles(self):
-    storage_filename = self._get_storage_filename()
-    volume_manager = JsonVolumeManager(storage_filename)
-    return volume_manager.get_roles()
+    return self._get_volume_manager().get_roles()
   
   def _get_ec2_volumes_dict(self, mountable_volumes):
     volume_ids = [mv.volume_id for mv in sum(mountable_volumes, [])]
@@ -402,9 +807,7 @@ class Ec2Storage(Storage):
 
   def print_status(self, roles=None):
     if roles == None:
-      storage_filename = self._get_storage_filename()
-      volume_manager = JsonVolumeManager(storage_filename)
-      roles = volume_manager.get_roles()
+      roles = self._get_volume_manager().get_roles()
     for role in roles:
       mountable_volumes_list = self._get_mountable_volumes(role)
       ec2_volumes = self._get_ec2_volumes_dict(mountable_volumes_list)
@@ -422,6 +825,13 @@ class Ec2Storage(Storage):
     if not mountable_volumes_list:
       return
     ec2_volumes = self._get_ec2_volumes_dict(mountable_volumes_list)
+    creating = [volume.id for volume in ec2_volumes.values()
+                if volume.status == 'creating']
+    if creating:
+      print "Waiting for %s volumes to be created" % len(creating)
+      _wait_for_volumes(self.cluster.ec2Connection, creating)
+      print
+      ec2_volumes = self._get_ec2_volumes_dict(mountable_volumes_list)
 
     available_mountable_volumes_list = []
 
@@ -451,17 +861,31 @@ class Ec2Storage(Storage):
         % (len(available_instances_dict),
            len(available_mountable_volumes_list)))
 
+    attachments = []
     for (instance, mountable_volumes) in zip(available_instances_dict.values(),
                                              available_mountable_volumes_list):
       print "Attaching storage to %s" % instance.id
       for mountable_volume in mountable_volumes:
-        volume = ec2_volumes[mountable_volume.volume_id]
-        print "Attaching %s to %s" % (volume.id, instance.id)
-        volume.attach(instance.id, mountable_volume.device)
+        attachments.append((instance, mountable_volume))
+    def attach_volume(attachment):
+      (instance, mountable_volume) = attachment
+      volume = ec2_volumes[mountable_volume.volume_id]
+      print "Attaching %s to %s" % (volume.id, instance.id)
+      _attach_volume(volume, instance.id, mountable_volume.device)
+      return volume.id
+    attached = []
+    for (volume_id, e) in run_in_parallel(attach_volume, attachments):
+      if e != None:
+        logger.error("Failed to attach volume: %s", e)
+      else:
+        attached.append(volume_id)
+    if attached:
+      print "Waiting for %s volumes to attach" % len(attached)
+      _wait_for_volumes(self.cluster.ec2Connection, attached, 'in-use')
+      print
 
   def delete(self, roles=[]):
-    storage_filename = self._get_storage_filename()
-    volume_manager = JsonVolumeManager(storage_filename)
+    volume_manager = self._get_volume_manager()
     for role in roles:
       mountable_volumes_list = volume_manager.get_instance_storage_for_role(role)
       ec2_volumes = self._get_ec2_volumes_dict(mountable_volumes_list)
@@ -0,0 +1,497 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A simulated EC2 region, for running Ec2Cluster without an AWS account.
+
+FakeEc2Connection is a boto EC2Connection whose HTTP requests are answered
+in-process by a FakeEc2 rather than sent to AWS, so everything above the
+socket -- request building, signing, response parsing and Ec2Cluster
+itself -- is the real code. FakeEc2Cluster is an Ec2Cluster which connects
+to the shared FakeEc2Cluster.cloud.
+"""
+
+from __future__ import with_statement
+
+from boto.ec2.connection import EC2Connection
+from hadoop.cloud.providers.ec2 import Ec2Cluster
+from xml.sax.saxutils import escape
+import base64
+import calendar
+import cgi
+import fnmatch
+import hashlib
+import hmac
+import logging
+import StringIO
+import threading
+import time
+import urllib
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+OWNER_ID = "123456789012"
+
+_STATE_CODES = { "pending": 0, "running": 16, "shutting-down": 32,
+                 "terminated": 48 }
+
+class FakeEc2Error(Exception):
+  """
+  An error response from the simulated EC2.
+  """
+  def __init__(self, code, message, status=400):
+    Exception.__init__(self, "%s: %s" % (code, message))
+    self.code = code
+    self.message = message
+    self.status = status
+
+class FakeResponse(object):
+  """
+  The parts of an httplib.HTTPResponse that boto reads.
+  """
+  def __init__(self, status, reason, body):
+    self.status = status
+    self.reason = reason
+    self._body = StringIO.StringIO(body)
+
+  def read(self, amt=None):
+    if amt is None:
+      return self._body.read()
+    return self._body.read(amt)
+
+  def getheader(self, name, default=None):
+    return default
+
+class FakeInstance(object):
+
+  def __init__(self, id, reservation_id, groups, image_id, instance_type,
+               key_name, placement, launch_index, user_data, launch_time):
+    self.id = id
+    self.reservation_id = reservation_id
+    self.groups = groups
+    self.image_id = image_id
+    self.instance_type = instance_type
+    self.key_name = key_name
+    self.placement = placement
+    self.launch_index = launch_index
+    self.user_data = user_data
+    self.launch_time = launch_time
+    self.terminate_time = None
+    n = int(id[2:], 16)
+    self.private_ip = "10.0.%s.%s" % (n / 250, n % 250 + 1)
+    self.public_ip = "50.0.%s.%s" % (n / 250, n % 250 + 1)
+
+class FakeEc2(object):
+  """
+  A simulated EC2 region, holding security groups and instances in memory.
+
+  It models what makes cluster commands slow: every request takes latency
+  seconds, instances take boot_time seconds to start running, and new
+  instances only show up in DescribeInstances consistency_delay seconds
+  after they are launched. Requests must be signed (signature version 2)
+  with access_key and secret_key, and pre-signed URLs must not have
+  expired. api_calls counts the requests made, by action.
+  """
+
+  def __init__(self, latency=0, boot_time=0, consistency_delay=0,
+               access_key="fake-access-key", secret_key="fake-secret-key"):
+    self.latency = latency
+    self.boot_time = boot_time
+    self.consistency_delay = consistency_delay
+    self.access_key = access_key
+    self.secret_key = secret_key
+    self.api_calls = {}
+    self._lock = threading.Lock()
+    self._groups = {} # name -> (description, [permission])
+    self._instances = []
+    self._reservations = 0
+
+  def connect(self):
+    """
+    Return a new FakeEc2Connection to this region.
+    """
+    return FakeEc2Connection(self)
+
+  def fetch(self, url):
+    """
+    Return the body of the response to a GET of a (pre-signed) URL, as an
+    instance booting would see it, or raise FakeEc2Error.
+    """
+    (scheme, host, path, query, fragment) = urlparse.urlsplit(url)
+    response = self.request("GET", host, "%s?%s" % (path, query), "")
+    if response.status != 200:
+      raise FakeEc2Error("HTTP%d" % response.status, response.read(),
+                         response.status)
+    return response.read()
+
+  def user_data(self, instance_id):
+    """
+    Return the user data an instance was launched with.
+    """
+    return self._get_instance(instance_id).user_data
+
+  def request(self, method, host, path, body):
+    """
+    Answer an HTTP request, returning a FakeResponse.
+    """
+    (path, sep, query) = path.partition("?")
+    if method == "POST":
+      query = body
+    params = dict(cgi.parse_qsl(query, keep_blank_values=True))
+    action = params.get("Action", "")
+    with self._lock:
+      self.api_calls[action] = self.api_calls.get(action, 0) + 1
+    logger.debug("%s %s", action, params)
+    if self.latency:
+      time.sleep(self.latency)
+    try:
+      self._check_signature(method, host, path, params)
+      handler = getattr(self, "do_%s" % action, None)
+      if handler is None:
+        raise FakeEc2Error("InvalidAction",
+                           "The action %s is not valid" % action)
+      with self._lock:
+        body = handler(params)
+      return FakeResponse(200, "OK",
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<%sResponse xmlns="http://ec2.amazonaws.com/doc/%s/">'
+        '<requestId>%s</requestId>%s</%sResponse>' %
+        (action, EC2Connection.APIVersion, self._request_id(), body, action))
+    except FakeEc2Error, e:
+      return FakeResponse(e.status, "Error",
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Response><Errors><Error><Code>%s</Code><Message>%s</Message>'
+        '</Error></Errors><RequestID>%s</RequestID></Response>' %
+        (e.code, escape(e.message), self._request_id()))
+
+  def _request_id(self):
+    return "%08x" % sum(self.api_calls.values())
+
+  def _check_signature(self, method, host, path, params):
+    """
+    Check a request's signature the way EC2 does, independently of boto's
+    signing code.
+    """
+    signature = params.pop("Signature", None)
+    if params.get("AWSAccessKeyId") != self.access_key:
+      raise FakeEc2Error("AuthFailure", "Unknown access key", 401)
+    if params.get("SignatureVersion") != "2":
+      raise FakeEc2Error("AuthFailure", "Unsupported signature version", 401)
+    digest = { "HmacSHA256": hashlib.sha256,
+               "HmacSHA1": hashlib.sha1 }.get(params.get("SignatureMethod"))
+    if digest is None:
+      raise FakeEc2Error("AuthFailure", "Unsupported signature method", 401)
+    if "Expires" in params:
+      expires = calendar.timegm(time.strptime(params["Expires"],
+                                              "%Y-%m-%dT%H:%M:%SZ"))
+      if expires < time.time():
+        raise FakeEc2Error("RequestExpired", "Request has expired", 400)
+    elif "Timestamp" not in params:
+      raise FakeEc2Error("MissingParameter", "Timestamp or Expires", 400)
+    query = "&".join(["%s=%s" % (urllib.quote(key, safe="-_.~"),
+                                 urllib.quote(value, safe="-_.~"))
+                      for (key, value) in sorted(params.items())])
+    string_to_sign = "\n".join((method, host.lower(), path or "/", query))
+    expected = base64.b64encode(hmac.new(self.secret_key, string_to_sign,
+                                         digest).digest())
+    if signature != expected:
+      raise FakeEc2Error("SignatureDoesNotMatch",
+                         "The request signature does not match", 403)
+
+  # Request parameters
+
+  def _list_param(self, params, label):
+    values = []
+    i = 1
+    while "%s.%d" % (label, i) in params:
+      values.append(params["%s.%d" % (label, i)])
+      i += 1
+    return values
+
+  def _filters(self, params):
+    filters = []
+    i = 1
+    while "Filter.%d.Name" % i in params:
+      filters.append((params["Filter.%d.Name" % i],
+                      self._list_param(params, "Filter.%d.Value" % i)))
+      i += 1
+    return filters
+
+  # Instances
+
+  def _state(self, instance, now):
+    if instance.terminate_time is not None:
+      return "terminated"
+    if now - instance.launch_time < self.boot_time:
+      return "pending"
+    return "running"
+
+  def _visible(self, instance, now):
+    return now - instance.launch_time >= self.consistency_delay
+
+  def _get_instance(self, instance_id):
+    for instance in self._instances:
+      if instance.id == instance_id:
+        return instance
+    raise FakeEc2Error("InvalidInstanceID.NotFound",
+                       "The instance ID '%s' does not exist" % instance_id)
+
+  def _matches(self, instance, state, filters):
+    values_by_name = {
+      "group-name": instance.groups,
+      "instance-id": [instance.id],
+      "instance-state-name": [state],
+      "key-name": [instance.key_name or ""],
+      "instance-type": [instance.instance_type],
+      "image-id": [instance.image_id],
+    }
+    for (name, patterns) in filters:
+      if name not in values_by_name:
+        raise FakeEc2Error("InvalidParameterValue",
+                           "The filter '%s' is invalid" % name)
+      if not [value for value in values_by_name[name]
+              for pattern in patterns
+              if fnmatch.fnmatchcase(value, pattern)]:
+        return False
+    return True
+
+  def _instance_xml(self, instance, state):
+    if state == "running":
+      # Addresses rather than names, so that they resolve without DNS
+      dns_name = instance.public_ip
+      private_dns_name = instance.private_ip
+      addresses = "<privateIpAddress>%s</privateIpAddress>" \
+        "<ipAddress>%s</ipAddress>" % (instance.private_ip, instance.public_ip)
+    else:
+      (dns_name, private_dns_name, addresses) = ("", "", "")
+    return "<item><instanceId>%s</instanceId><imageId>%s</imageId>" \
+      "<instanceState><code>%d</code><name>%s</name></instanceState>" \
+      "<privateDnsName>%s</privateDnsName><dnsName>%s</dnsName><reason/>" \
+      "<keyName>%s</keyName><amiLaunchIndex>%d</amiLaunchIndex>" \
+      "<productCodes/><instanceType>%s</instanceType>" \
+      "<launchTime>%s</launchTime><placement><availabilityZone>%s" \
+      "</availabilityZone><groupName/></placement>" \
+      "<monitoring><state>disabled</state></monitoring>%s" \
+      "<rootDeviceType>instance-store</rootDeviceType><blockDeviceMapping/>" \
+      "</item>" % (instance.id, escape(instance.image_id), _STATE_CODES[state],
+        state, private_dns_name, dns_name, escape(instance.key_name or ""),
+        instance.launch_index, escape(instance.instance_type),
+        time.strftime("%Y-%m-%dT%H:%M:%S.000Z",
+                      time.gmtime(instance.launch_time)),
+        escape(instance.placement), addresses)
+
+  def _reservation_xml(self, reservation_id, groups, items):
+    return "<reservationId>%s</reservationId><ownerId>%s</ownerId>" \
+      "<groupSet>%s</groupSet><instancesSet>%s</instancesSet>" % \
+      (reservation_id, OWNER_ID,
+       "".join(["<item><groupId>%s</groupId></item>" % escape(group)
+                for group in groups]),
+       "".join(items))
+
+  def do_DescribeInstances(self, params):
+    now = time.time()
+    instance_ids = self._list_param(params, "InstanceId")
+    filters = self._filters(params)
+    for instance_id in instance_ids:
+      if not self._visible(self._get_instance(instance_id), now):
+        raise FakeEc2Error("InvalidInstanceID.NotFound",
+                           "The instance ID '%s' does not exist" % instance_id)
+    reservations = []
+    by_reservation = {}
+    for instance in self._instances:
+      if not self._visible(instance, now):
+        continue
+      if instance_ids and instance.id not in instance_ids:
+        continue
+      state = self._state(instance, now)
+      if not self._matches(instance, state, filters):
+        continue
+      if instance.reservation_id not in by_reservation:
+        reservations.append((instance.reservation_id, instance.groups))
+        by_reservation[instance.reservation_id] = []
+      by_reservation[instance.reservation_id].append(
+        self._instance_xml(instance, state))
+    return "<reservationSet>%s</reservationSet>" % "".join(
+      ["<item>%s</item>" % self._reservation_xml(reservation_id, groups,
+                                                 by_reservation[reservation_id])
+       for (reservation_id, groups) in reservations])
+
+  def do_RunInstances(self, params):
+    groups = self._list_param(params, "SecurityGroup") or ["default"]
+    for group in groups:
+      if group != "default" and group not in self._groups:
+        raise FakeEc2Error("InvalidGroup.NotFound",
+                           "The security group '%s' does not exist" % group)
+    count = int(params.get("MaxCount", params.get("MinCount", "1")))
+    self._reservations += 1
+    reservation_id = "r-%08x" % self._reservations
+    now = time.time()
+    instances = []
+    for i in range(count):
+      instance = FakeInstance("i-%08x" % (len(self._instances) + 1),
+        reservation_id, groups, params["ImageId"],
+        params.get("InstanceType", "m1.small"), params.get("KeyName"),
+        params.get("Placement.AvailabilityZone", "us-east-1a"), i,
+        base64.b64decode(params.get("UserData", "")), now)
+      self._instances.append(instance)
+      instances.append(instance)
+    return self._reservation_xml(reservation_id, groups,
+      [self._instance_xml(instance, "pending") for instance in instances])
+
+  def do_TerminateInstances(self, params):
+    now = time.time()
+    items = []
+    for instance_id in self._list_param(params, "InstanceId"):
+      instance = self._get_instance(instance_id)
+      previous_state = self._state(instance, now)
+      if instance.terminate_time is None:
+        instance.terminate_time = now
+      items.append("<item><instanceId>%s</instanceId>"
+        "<currentState><code>%d</code><name>%s</name></currentState>"
+        "<previousState><code>%d</code><name>%s</name></previousState>"
+        "</item>" % (instance.id, _STATE_CODES["terminated"], "terminated",
+                     _STATE_CODES[previous_state], previous_state))
+    return "<instancesSet>%s</instancesSet>" % "".join(items)
+
+  # Security groups
+
+  def _get_group(self, name):
+    if name not in self._groups:
+      raise FakeEc2Error("InvalidGroup.NotFound",
+                         "The security group '%s' does not exist" % name)
+    return self._groups[name]
+
+  def _group_xml(self, name):
+    (description, permissions) = self._groups[name]
+    items = []
+    for (protocol, from_port, to_port, groups, cidr_ips) in permissions:
+      items.append("<item><ipProtocol>%s</ipProtocol><fromPort>%d</fromPort>"
+        "<toPort>%d</toPort><groups>%s</groups><ipRanges>%s</ipRanges>"
+        "</item>" % (protocol, from_port, to_port,
+          "".join(["<item><userId>%s</userId><groupName>%s</groupName></item>"
+                   % (OWNER_ID, escape(group)) for group in groups]),
+          "".join(["<item><cidrIp>%s</cidrIp></item>" % escape(cidr_ip)
+                   for cidr_ip in cidr_ips])))
+    return "<item><ownerId>%s</ownerId><groupName>%s</groupName>" \
+      "<groupDescription>%s</groupDescription>" \
+      "<ipPermissions>%s</ipPermissions></item>" % \
+      (OWNER_ID, escape(name), escape(description), "".join(items))
+
+  def do_DescribeSecurityGroups(self, params):
+    names = self._list_param(params, "GroupName")
+    for name in names:
+      self._get_group(name)
+    return "<securityGroupInfo>%s</securityGroupInfo>" % "".join(
+      [self._group_xml(name) for name in sorted(self._groups)
+       if not names or name in names])
+
+  def do_CreateSecurityGroup(self, params):
+    name = params["GroupName"]
+    if name in self._groups:
+      raise FakeEc2Error("InvalidGroup.Duplicate",
+                         "The security group '%s' already exists" % name)
+    self._groups[name] = (params.get("GroupDescription", ""), [])
+    return "<return>true</return>"
+
+  def do_DeleteSecurityGroup(self, params):
+    name = params["GroupName"]
+    self._get_group(name)
+    now = time.time()
+    for instance in self._instances:
+      if name in instance.groups and \
+          self._state(instance, now) != "terminated":
+        raise FakeEc2Error("InvalidGroup.InUse",
+                           "There are active instances using '%s'" % name)
+    del self._groups[name]
+    return "<return>true</return>"
+
+  def _requested_permissions(self, params):
+    """
+    Return the (protocol, from_port, to_port, [group], [cidr_ip]) tuples of an
+    authorize request, in either the IpPermissions form or the older form
+    granting a whole group access.
+    """
+    if "SourceSecurityGroupName" in params:
+      group = [params["SourceSecurityGroupName"]]
+      return [("tcp", 0, 65535, group, []), ("udp", 0, 65535, group, []),
+              ("icmp", -1, -1, group, [])]
+    permissions = []
+    i = 1
+    while "IpPermissions.%d.IpProtocol" % i in params or \
+        "IpPermissions.%d.Groups.1.GroupName" % i in params:
+      prefix = "IpPermissions.%d." % i
+      permissions.append((params.get(prefix + "IpProtocol", "tcp"),
+        int(params.get(prefix + "FromPort", 0)),
+        int(params.get(prefix + "ToPort", 65535)),
+        [params[key] for key in sorted(params)
+         if key.startswith(prefix + "Groups.")
+           and key.endswith(".GroupName")],
+        [urllib.unquote(params[key]) for key in sorted(params)
+         if key.startswith(prefix + "IpRanges.")
+           and key.endswith(".CidrIp")]))
+      i += 1
+    if not permissions:
+      raise FakeEc2Error("MissingParameter", "No permissions given")
+    return permissions
+
+  def do_AuthorizeSecurityGroupIngress(self, params):
+    (description, permissions) = self._get_group(params["GroupName"])
+    existing = {}
+    for (protocol, from_port, to_port, groups, cidr_ips) in permissions:
+      existing[(protocol, from_port, to_port)] = (groups, cidr_ips)
+    requested = self._requested_permissions(params)
+    for (protocol, from_port, to_port, groups, cidr_ips) in requested:
+      (have_groups, have_cidr_ips) = existing.get(
+        (protocol, from_port, to_port), ([], []))
+      for grant in [group for group in groups if group in have_groups] + \
+          [cidr_ip for cidr_ip in cidr_ips if cidr_ip in have_cidr_ips]:
+        raise FakeEc2Error("InvalidPermission.Duplicate",
+          "The permission '%s-%s-%s-%s' has already been authorized" %
+          (protocol, from_port, to_port, grant))
+    for (protocol, from_port, to_port, groups, cidr_ips) in requested:
+      key = (protocol, from_port, to_port)
+      if key not in existing:
+        existing[key] = ([], [])
+        permissions.append((protocol, from_port, to_port) + existing[key])
+      existing[key][0].extend(groups)
+      existing[key][1].extend(cidr_ips)
+    return "<return>true</return>"
+
+class FakeEc2Connection(EC2Connection):
+  """
+  An EC2Connection to a FakeEc2. Only sending the request and receiving the
+  response is simulated.
+  """
+
+  def __init__(self, cloud):
+    EC2Connection.__init__(self, cloud.access_key, cloud.secret_key)
+    self.cloud = cloud
+
+  def _mexe(self, method, path, data, headers, host=None, sender=None,
+            override_num_retries=None):
+    return self.cloud.request(method, host or self.host, path, data)
+
+class FakeEc2Cluster(Ec2Cluster):
+  """
+  An Ec2Cluster in the simulated region FakeEc2Cluster.cloud, which is shared
+  by every FakeEc2Cluster in the process.
+  """
+
+  cloud = FakeEc2()
+
+  @classmethod
+  def _connect(cls):
+    return cls.cloud.connect()
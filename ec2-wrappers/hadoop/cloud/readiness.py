@@ -0,0 +1,118 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Probes for finding out when the daemons in a cluster have started.
+"""
+
+import httplib
+import logging
+import re
+import socket
+
+logger = logging.getLogger(__name__)
+
+class HttpProbe(object):
+  """
+  Fetches pages from a web server, keeping one connection open between
+  requests rather than connecting afresh for each.
+  """
+
+  def __init__(self, host, port=80, timeout=5):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self._connection = None
+
+  def get(self, path, headers={}):
+    """
+    Fetch a page.
+    @return: a (status, body) pair
+    @raise IOError: if the server could not be reached
+    """
+    if self._connection is None:
+      self._connection = httplib.HTTPConnection(self.host, self.port,
+                                                timeout=self.timeout)
+    try:
+      self._connection.request("GET", path, headers=headers)
+      response = self._connection.getresponse()
+      return (response.status, response.read())
+    except (httplib.HTTPException, socket.error), e:
+      logger.debug("Fetching http://%s:%s%s failed: %s", self.host, self.port,
+                   path, e)
+      self.close()
+      raise IOError(e)
+
+  def close(self):
+    if self._connection is not None:
+      self._connection.close()
+      self._connection = None
+
+class JobTrackerProbe(HttpProbe):
+  """
+  Reports which tasktrackers have registered with a jobtracker.
+  """
+
+  _TRACKER_NAME = re.compile(r'tracker_([^:<\s]+):')
+
+  def __init__(self, host, port=50030, timeout=5):
+    super(JobTrackerProbe, self).__init__(host, port, timeout)
+
+  def tasktrackers(self):
+    """
+    @return: the set of hosts with a live tasktracker
+    @raise IOError: if the jobtracker is not yet serving
+    """
+    # The optional ?type=active is a difference between Hadoop 0.18 and 0.20
+    (status, page) = self.get("/machines.jsp?type=active")
+    if status != httplib.OK:
+      raise IOError("Jobtracker returned HTTP status %s" % status)
+    return set(self._TRACKER_NAME.findall(page))
+
+class StatusFileProbe(HttpProbe):
+  """
+  Tails the status file which the init scripts publish on the namenode's web
+  server. Each line of the file is "<time> <host> <event>".
+  """
+
+  def __init__(self, host, path="/hadoop-status", port=80, timeout=5):
+    super(StatusFileProbe, self).__init__(host, port, timeout)
+    self.path = path
+    self._offset = 0
+    self._partial_line = ""
+
+  def read_events(self):
+    """
+    @return: a list of (host, event) pairs for the lines added to the file
+    since the last call; empty if the file has not been published yet
+    @raise IOError: if the web server could not be reached
+    """
+    (status, body) = self.get(self.path,
+                              { 'Range': 'bytes=%d-' % self._offset })
+    if status == httplib.OK:
+      # The server ignored the range
+      body = body[self._offset:]
+    elif status != httplib.PARTIAL_CONTENT:
+      # Not published yet, or nothing new
+      return []
+    self._offset += len(body)
+    lines = (self._partial_line + body).split("\n")
+    self._partial_line = lines.pop()
+    events = []
+    for line in lines:
+      fields = line.split(None, 2)
+      if len(fields) == 3:
+        events.append((fields[1], fields[2]))
+    return events
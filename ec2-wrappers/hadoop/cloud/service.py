@@ -19,19 +19,25 @@ Classes for running services on a cluster.
 
 from __future__ import with_statement
 
+from hadoop.cloud import tracing
 from hadoop.cloud.cluster import get_cluster
 from hadoop.cloud.cluster import InstanceUserData
 from hadoop.cloud.cluster import TimeoutException
 from hadoop.cloud.providers.ec2 import Ec2Storage
+from hadoop.cloud.readiness import JobTrackerProbe
+from hadoop.cloud.readiness import StatusFileProbe
+from hadoop.cloud.ssh import SshFanOut
+from hadoop.cloud.util import backoff_delays
 from hadoop.cloud.util import build_env_string
 from hadoop.cloud.util import url_get
 from hadoop.cloud.util import xstr
 import logging
 import os
-import re
+import shutil
 import socket
 import subprocess
 import sys
+import tempfile
 import time
 
 logger = logging.getLogger(__name__)
@@ -77,6 +83,9 @@ class Service(object):
   """
   A general service that runs on a cluster.
   """
+
+  # Seconds to wait for launched instances to start running
+  INSTANCE_TIMEOUT = 600
   
   def __init__(self, cluster):
     self.cluster = cluster
@@ -193,42 +202,63 @@ class Service(object):
     return os.path.join(data_path, '%s-%s-init-remote.sh' %
                  (self.get_service_code(), self.cluster.get_provider_code()))
 
+  def _get_user_data_file_template(self, instance_template):
+    if instance_template.user_data_file_template == None:
+      return self._get_default_user_data_file_template()
+    return instance_template.user_data_file_template
+
+  def _get_instance_user_data(self, user_data_file_template, replacements={}):
+    return InstanceUserData(user_data_file_template, replacements,
+                            os.path.join(self.cluster.config_dir, "cache"))
+
   def _launch_instances(self, instance_template):
+    instance_ids = self._start_instances(instance_template)
+    return self._wait_for_instances(instance_template, instance_ids)
+
+  def _start_instances(self, instance_template):
     it = instance_template
-    user_data_file_template = it.user_data_file_template
-    if it.user_data_file_template == None:
-      user_data_file_template = self._get_default_user_data_file_template()
-    ebs_mappings = ''
-    storage = self.cluster.get_storage()
-    for role in it.roles:
-      if storage.has_any_storage((role,)):
-        ebs_mappings = storage.get_mappings_string_for_role(role)
-    replacements = { "%ENV%": build_env_string(it.env_strings, {
-      "ROLES": ",".join(it.roles),
-      "USER_PACKAGES": it.user_packages,
-      "AUTO_SHUTDOWN": it.auto_shutdown,
-      "EBS_MAPPINGS": ebs_mappings,
-      "AWS_ACCESS_KEY_ID": os.environ['AWS_ACCESS_KEY_ID'],
-      "AWS_SECRET_ACCESS_KEY": os.environ['AWS_SECRET_ACCESS_KEY']
-    }) }
-    instance_user_data = InstanceUserData(user_data_file_template, replacements)
-    instance_ids = self.cluster.launch_instances(it.roles, it.number, it.image_id,
-                                            it.size_id,
-                                            instance_user_data,
-                                            key_name=it.key_name,
-                                            public_key=it.public_key,
-                                            placement=it.placement)
-    print "Waiting for %s instances in role %s to start" % \
-      (it.number, ",".join(it.roles))
-    try:
-      self.cluster.wait_for_instances(instance_ids)
-      print "%s instances started" % ",".join(it.roles)
-    except TimeoutException:
-      print "Timeout while waiting for %s instance to start." % ",".join(it.roles)
-      return
-    print
-    self.cluster.print_status(it.roles[0])
-    return self.cluster.get_instances_in_role(it.roles[0], "running")
+    with tracing.phase("start_instances", roles=",".join(it.roles),
+                       number=it.number):
+      user_data_file_template = self._get_user_data_file_template(it)
+      ebs_mappings = ''
+      storage = self.cluster.get_storage()
+      for role in it.roles:
+        if storage.has_any_storage((role,)):
+          ebs_mappings = storage.get_mappings_string_for_role(role)
+      replacements = { "%ENV%": build_env_string(it.env_strings, {
+        "ROLES": ",".join(it.roles),
+        "USER_PACKAGES": it.user_packages,
+        "AUTO_SHUTDOWN": it.auto_shutdown,
+        "EBS_MAPPINGS": ebs_mappings,
+        "AWS_ACCESS_KEY_ID": os.environ['AWS_ACCESS_KEY_ID'],
+        "AWS_SECRET_ACCESS_KEY": os.environ['AWS_SECRET_ACCESS_KEY']
+      }) }
+      instance_user_data = self._get_instance_user_data(user_data_file_template,
+                                                        replacements)
+      instance_ids = self.cluster.launch_instances(it.roles, it.number,
+                                                   it.image_id, it.size_id,
+                                                   instance_user_data,
+                                                   key_name=it.key_name,
+                                                   public_key=it.public_key,
+                                                   placement=it.placement)
+      return instance_ids
+
+  def _wait_for_instances(self, instance_template, instance_ids):
+    it = instance_template
+    with tracing.phase("wait_for_instances", roles=",".join(it.roles),
+                       number=it.number):
+      print "Waiting for %s instances in role %s to start" % \
+        (it.number, ",".join(it.roles))
+      try:
+        self.cluster.wait_for_instances(instance_ids, self.INSTANCE_TIMEOUT)
+        print "%s instances started" % ",".join(it.roles)
+      except TimeoutException:
+        print "Timeout while waiting for %s instance to start." % \
+          ",".join(it.roles)
+        return
+      print
+      self.cluster.print_status((it.roles[0],))
+      return self.cluster.get_instances_in_role(it.roles[0], "running")
 
   
 class HadoopService(Service):
@@ -246,9 +276,8 @@ class HadoopService(Service):
     """
     Find and print clusters that have a running namenode instances
     """
-    legacy_clusters = get_cluster(provider).get_clusters_with_role(MASTER)
-    clusters = list(get_cluster(provider).get_clusters_with_role(NAMENODE))
-    clusters.extend(legacy_clusters)
+    clusters = get_cluster(provider).get_clusters_with_roles((NAMENODE,
+                                                              MASTER))
     if not clusters:
       print "No running clusters"
     else:
@@ -345,14 +374,21 @@ echo Proxy pid %s, port %s;""" % (process.pid, process.pid, proxy_port)
     with open(slaves_file, 'w') as f:
       for slave in slaves:
         f.write(slave.public_ip + "\n")
-    subprocess.call('scp %s -r %s root@%s:/etc/hadoop/conf' % \
-                    (ssh_options, slaves_file, master.public_ip), shell=True)
-    # Copy private key
-    subprocess.call('scp %s -r %s root@%s:/root/.ssh/id_rsa' % \
-                    (ssh_options, private_key, master.public_ip), shell=True)
-    for slave in slaves:
-      subprocess.call('scp %s -r %s root@%s:/root/.ssh/id_rsa' % \
-                      (ssh_options, private_key, slave.public_ip), shell=True)
+    fan_out = SshFanOut(ssh_options)
+    try:
+      # Copy the slaves file and private key to the master, and the private
+      # key to each slave
+      commands = { master.public_ip: [
+        fan_out.scp_command(master.public_ip, slaves_file, '/etc/hadoop/conf'),
+        fan_out.scp_command(master.public_ip, private_key,
+                            '/root/.ssh/id_rsa')] }
+      for slave in slaves:
+        if slave.public_ip not in commands:
+          commands[slave.public_ip] = [fan_out.scp_command(
+            slave.public_ip, private_key, '/root/.ssh/id_rsa')]
+      fan_out.print_failures(fan_out.run(commands))
+    finally:
+      fan_out.close()
         
   def _get_master(self):
     # For split namenode/jobtracker, designate the namenode as the master
@@ -370,7 +406,43 @@ echo Proxy pid %s, port %s;""" % (process.pid, process.pid, proxy_port)
       return None
     return instances[0]
 
+  def _get_singleton_lookup_urls(self, instance_templates):
+    """
+    Return "<ROLE>_HOST_URL=<url>" environment strings which let instances
+    find the singleton (e.g. namenode) instances at boot, or None if the
+    cluster or any of the user data templates doesn't support this. The URLs
+    expire, and the instances give up on them, once the launch has timed out.
+    """
+    deadline = int(time.time()) + self.INSTANCE_TIMEOUT
+    lookup_urls = ["HOST_LOOKUP_DEADLINE=%d" % deadline]
+    for instance_template in instance_templates:
+      template = self._get_user_data_file_template(instance_template)
+      if self._get_instance_user_data(template).read().find("_HOST_URL") == -1:
+        return None
+      if instance_template.number != 1:
+        continue
+      for role in instance_template.roles:
+        url = self.cluster.get_role_lookup_url(role, self.INSTANCE_TIMEOUT)
+        if url == None:
+          return None
+        lookup_urls.append("%s_HOST_URL=%s" %
+                           (self._sanitize_role_name(role), url))
+    return lookup_urls
+
+  @tracing.traced("launch_instances")
   def _launch_cluster_instances(self, instance_templates):
+    lookup_urls = self._get_singleton_lookup_urls(instance_templates)
+    if lookup_urls != None:
+      # Start every template at once and let the instances find the
+      # singletons themselves, rather than waiting for each in turn.
+      launched = []
+      for instance_template in instance_templates:
+        instance_template.add_env_strings(lookup_urls)
+        launched.append((instance_template,
+                         self._start_instances(instance_template)))
+      for (instance_template, instance_ids) in launched:
+        self._wait_for_instances(instance_template, instance_ids)
+      return
     singleton_hosts = []
     for instance_template in instance_templates:
       instance_template.add_env_strings(singleton_hosts)
@@ -392,6 +464,7 @@ echo Proxy pid %s, port %s;""" % (process.pid, process.pid, proxy_port)
     """Replace characters in role name with ones allowed in bash variable names"""
     return role.replace('+', '_').upper()
 
+  @tracing.traced("authorize_client_ports")
   def _authorize_client_ports(self, client_cidrs=[]):
     if not client_cidrs:
       logger.debug("No client CIDRs specified, using local address.")
@@ -400,26 +473,27 @@ echo Proxy pid %s, port %s;""" % (process.pid, process.pid, proxy_port)
     logger.debug("Client CIDRs: %s", client_cidrs)
     namenode = self._get_namenode()
     jobtracker = self._get_jobtracker()
+    rules = []
     for client_cidr in client_cidrs:
       # Allow access to port 80 on namenode from client
-      self.cluster.authorize_role(NAMENODE, 80, 80, client_cidr)
+      rules.append((NAMENODE, 80, 80, client_cidr))
       # Allow access to jobtracker UI on master from client
       # (so we can see when the cluster is ready)
-      self.cluster.authorize_role(JOBTRACKER, 50030, 50030, client_cidr)
-      self.cluster.authorize_role(NAMENODE, 50070, 50070, client_cidr)
+      rules.append((JOBTRACKER, 50030, 50030, client_cidr))
+      rules.append((NAMENODE, 50070, 50070, client_cidr))
 
-      self.cluster.authorize_role(TASKTRACKER, 50060, 50060, client_cidr)
-      self.cluster.authorize_role(DATANODE, 50075, 50075, client_cidr)
+      rules.append((TASKTRACKER, 50060, 50060, client_cidr))
+      rules.append((DATANODE, 50075, 50075, client_cidr))
 
 #
     # Allow access to namenode and jobtracker via public address from each other
     namenode_ip = socket.gethostbyname(namenode.public_ip)
     jobtracker_ip = socket.gethostbyname(jobtracker.public_ip)
-    self.cluster.authorize_role(NAMENODE, 8020, 8020, "%s/32" % namenode_ip)
-    self.cluster.authorize_role(NAMENODE, 8020, 8020, "%s/32" % jobtracker_ip)
-    self.cluster.authorize_role(JOBTRACKER, 8021, 8021, "%s/32" % namenode_ip)
-    self.cluster.authorize_role(JOBTRACKER, 8021, 8021,
-                                "%s/32" % jobtracker_ip)
+    rules.append((NAMENODE, 8020, 8020, "%s/32" % namenode_ip))
+    rules.append((NAMENODE, 8020, 8020, "%s/32" % jobtracker_ip))
+    rules.append((JOBTRACKER, 8021, 8021, "%s/32" % namenode_ip))
+    rules.append((JOBTRACKER, 8021, 8021, "%s/32" % jobtracker_ip))
+    self.cluster.authorize_roles(rules)
   
   def _create_client_hadoop_site_file(self, config_dir, proxy_port):
     namenode = self._get_namenode()
@@ -477,53 +551,67 @@ echo Proxy pid %s, port %s;""" % (process.pid, process.pid, proxy_port)
     'aws_secret_access_key': aws_secret_access_key,
     'proxy_port': proxy_port})
 
+  @tracing.traced("wait_for_hadoop")
   def _wait_for_hadoop(self, number, timeout=600):
+    """
+    Waits for the jobtracker and then for number tasktrackers to start,
+    reporting each one as it comes up. Per-node readiness comes only from the
+    jobtracker's machines.jsp; the status file published on the namenode
+    just reports the master daemons starting. Polling slows down while
+    nothing changes, and speeds up again when something does.
+    """
     start_time = time.time()
     jobtracker = self._get_jobtracker()
     if not jobtracker:
       return
+    probes = [JobTrackerProbe(jobtracker.public_ip)]
+    namenode = self._get_namenode()
+    if namenode:
+      probes.append(StatusFileProbe(namenode.public_ip))
     print "Waiting for jobtracker to start"
-    previous_running = 0
-    while True:
-      if (time.time() - start_time >= timeout):
-        raise TimeoutException()
-      try:
-        actual_running = self._number_of_tasktrackers(jobtracker.public_ip, 1)
-        break
-      except IOError:
-        pass
-      sys.stdout.write(".")
-      sys.stdout.flush()
-      time.sleep(1)
-    print
-    if number > 0:
-      print "Waiting for %d tasktrackers to start" % number
-      while actual_running < number:
-        if (time.time() - start_time >= timeout):
-          raise TimeoutException()
+    trackers = None
+    delays = backoff_delays(1.0, 10.0)
+    try:
+      while True:
+        progress = False
+        if len(probes) > 1:
+          try:
+            for (host, event) in probes[1].read_events():
+              print
+              print "%s: %s" % (host, event)
+              progress = True
+          except IOError:
+            pass
         try:
-          actual_running = self._number_of_tasktrackers(jobtracker.public_ip, 5, 2)
-          if actual_running != previous_running:
-            sys.stdout.write("%d" % actual_running)
-          sys.stdout.write(".")
-          sys.stdout.flush()
-          time.sleep(1)
-          previous_running = actual_running
+          running = probes[0].tasktrackers()
+          if trackers is None:
+            print
+            print "Jobtracker started on %s" % jobtracker.public_ip
+            if number > 0:
+              print "Waiting for %d tasktrackers to start" % number
+            trackers = set()
+            progress = True
+          for host in sorted(running - trackers):
+            print
+            print "Tasktracker started on %s (%d of %d)" % \
+              (host, len(running), number)
+            progress = True
+          trackers = running
+          if len(trackers) >= number:
+            return
         except IOError:
           pass
-      print
-
-  # The optional ?type=active is a difference between Hadoop 0.18 and 0.20
-  _NUMBER_OF_TASK_TRACKERS = re.compile(
-    r'<a href="machines.jsp(?:\?type=active)?">(\d+)</a>')
-  
-  def _number_of_tasktrackers(self, jt_hostname, timeout, retries=0):
-    jt_page = url_get("http://%s:50030/jobtracker.jsp" % jt_hostname, timeout,
-                      retries)
-    m = self._NUMBER_OF_TASK_TRACKERS.search(jt_page)
-    if m:
-      return int(m.group(1))
-    return 0
+        if progress:
+          delays = backoff_delays(1.0, 10.0)
+        delay = delays.next()
+        if time.time() + delay - start_time >= timeout:
+          raise TimeoutException()
+        sys.stdout.write(".")
+        sys.stdout.flush()
+        time.sleep(delay)
+    finally:
+      for probe in probes:
+        probe.close()
 
   def _print_master_url(self):
     webserver = self._get_jobtracker()
@@ -531,11 +619,10 @@ echo Proxy pid %s, port %s;""" % (process.pid, process.pid, proxy_port)
       return
     print "Browse the cluster at http://%s/" % webserver.public_ip
 
+  @tracing.traced("attach_storage")
   def _attach_storage(self, roles):
     storage = self.cluster.get_storage()
     if storage.has_any_storage(roles):
-      print "Waiting 10 seconds before attaching storage"
-      time.sleep(10)
       for role in roles:
         storage.attach(role, self.cluster.get_instances_in_role(role, 'running'))
       storage.print_status(roles)
@@ -573,18 +660,32 @@ class ZooKeeperService(Service):
       client_ip = url_get('http://checkip.amazonaws.com/').strip()
       client_cidrs = ("%s/32" % client_ip,)
     logger.debug("Client CIDRs: %s", client_cidrs)
-    for client_cidr in client_cidrs:
-      self.cluster.authorize_role(self.ZOOKEEPER_ROLE, 2181, 2181, client_cidr)
+    self.cluster.authorize_roles([(self.ZOOKEEPER_ROLE, 2181, 2181, client_cidr)
+                                  for client_cidr in client_cidrs])
   
-  def _update_cluster_membership(self, public_key):
-    time.sleep(30) # wait for SSH daemon to start
-    
-    ssh_options = '-o StrictHostKeyChecking=no'
-    private_key = public_key[:-4] # TODO: pass in private key explicitly
+  def _update_cluster_membership(self, public_key, private_key=None):
+    if private_key is None:
+      private_key = public_key[:-4]
+    ssh_options = '-i %s -o StrictHostKeyChecking=no' % private_key
 
     instances = self.cluster.get_instances_in_role(self.ZOOKEEPER_ROLE,
                                                    'running')
-    config_file = 'zoo.cfg'
+    config_dir = tempfile.mkdtemp()
+    fan_out = SshFanOut(ssh_options)
+    try:
+      self._push_cluster_membership(instances, config_dir, fan_out)
+    finally:
+      fan_out.close()
+      shutil.rmtree(config_dir, True)
+
+    hosts_string = ",".join(["%s:2181" % i.public_ip for i in instances]) 
+    print "ZooKeeper cluster: %s" % hosts_string
+
+  def _push_cluster_membership(self, instances, config_dir, fan_out):
+    # The SSH daemons start some time after the instances are running
+    for host in fan_out.wait([i.public_ip for i in instances]):
+      print "Timeout waiting for SSH on %s" % host
+    config_file = os.path.join(config_dir, 'zoo.cfg')
     with open(config_file, 'w') as f:
       f.write("""# The number of milliseconds of each tick
 tickTime=2000
@@ -604,27 +705,22 @@ clientPort=2181
       for i in instances:
         f.write("server.%s=%s:2888:3888\n" % (counter, i.private_ip))
         counter += 1
-    # copy to each node in the cluster
-    myid_file = 'myid'
+    # copy to each node in the cluster, then start the zookeeper servers
+    commands = {}
     counter = 1
     for i in instances:
-      self._call('scp -i %s %s %s root@%s:/etc/zookeeper/conf/zoo.cfg' \
-                 % (private_key, ssh_options, config_file, i.public_ip))
+      myid_file = os.path.join(config_dir, 'myid-%s' % counter)
       with open(myid_file, 'w') as f:
         f.write(str(counter) + "\n")
-      self._call('scp -i %s %s %s root@%s:/var/log/zookeeper/txlog/myid' \
-                 % (private_key, ssh_options, myid_file, i.public_ip))
+      commands[i.public_ip] = [
+        fan_out.scp_command(i.public_ip, config_file,
+                            '/etc/zookeeper/conf/zoo.cfg'),
+        fan_out.scp_command(i.public_ip, myid_file,
+                            '/var/log/zookeeper/txlog/myid'),
+        fan_out.ssh_command(i.public_ip,
+                            'nohup /etc/rc.local > /dev/null 2>&1 &')]
       counter += 1
-    os.remove(config_file)
-    os.remove(myid_file)
-
-    # start the zookeeper servers
-    for i in instances:
-      self._call('ssh -i %s %s root@%s nohup /etc/rc.local &' \
-                 % (private_key, ssh_options, i.public_ip))
-      
-    hosts_string = ",".join(["%s:2181" % i.public_ip for i in instances]) 
-    print "ZooKeeper cluster: %s" % hosts_string
+    fan_out.print_failures(fan_out.run(commands))
 
 SERVICE_PROVIDER_MAP = {
   "hadoop": {
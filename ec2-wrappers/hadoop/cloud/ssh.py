@@ -0,0 +1,144 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Running commands on many instances at once over SSH.
+"""
+
+from hadoop.cloud.util import backoff_delays
+from hadoop.cloud.util import bash_quote
+from hadoop.cloud.util import run_in_parallel
+from hadoop.cloud.util import xstr
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+class SshFanOut(object):
+  """
+  Runs ssh and scp commands on a number of hosts, with a bounded number of
+  hosts in progress at once. The commands for each host share one SSH
+  connection (an OpenSSH ControlMaster), so only the first pays for the
+  handshake and authentication.
+  """
+
+  def __init__(self, ssh_options="", max_workers=20, control_persist=60):
+    self.ssh_options = xstr(ssh_options)
+    self.max_workers = max_workers
+    self._control_dir = tempfile.mkdtemp(prefix="hadoop-cloud-ssh-")
+    # The user's options come first so that they win over ours.
+    self._options = ('%s -o ControlMaster=auto -o ControlPath=%s ' \
+                     '-o ControlPersist=%s') % \
+                    (self.ssh_options,
+                     os.path.join(self._control_dir, "%r@%h:%p"),
+                     control_persist)
+    self._hosts = set()
+
+  def ssh_command(self, host, command, extra_options=""):
+    self._hosts.add(host)
+    return "ssh %s %s root@%s %s" % (self._options, extra_options, host,
+                                     bash_quote(command))
+
+  def scp_command(self, host, local_path, remote_path):
+    self._hosts.add(host)
+    return "scp %s -r %s root@%s:%s" % (self._options, local_path, host,
+                                        remote_path)
+
+  def _call(self, command):
+    logger.debug("Running %s", command)
+    # Not a pipe: a master connection that ssh leaves running in the
+    # background would hold it open, so reading to the end would block.
+    output = tempfile.TemporaryFile()
+    try:
+      returncode = subprocess.call(command, shell=True, stdout=output,
+                                   stderr=subprocess.STDOUT)
+      output.seek(0)
+      return (returncode, output.read())
+    finally:
+      output.close()
+
+  def run(self, host_commands):
+    """
+    Run commands on hosts. Each host's commands are run in order, stopping at
+    the first that fails; different hosts are worked on concurrently.
+    @param host_commands: a dict from host to a list of commands, built with
+    ssh_command and scp_command
+    @return: a dict from host to a (return code, output) pair for the last
+    command run on it
+    """
+    def run_host(host):
+      result = (0, "")
+      for command in host_commands[host]:
+        result = self._call(command)
+        if result[0] != 0:
+          break
+      return result
+    hosts = host_commands.keys()
+    results = {}
+    for (host, (result, exception)) in \
+        zip(hosts, run_in_parallel(run_host, hosts, self.max_workers)):
+      if exception is not None:
+        result = (-1, str(exception))
+      results[host] = result
+    return results
+
+  def wait(self, hosts, timeout=600):
+    """
+    Wait until all the hosts accept SSH logins, leaving a master connection
+    open to each for the commands that follow.
+    @return: the list of hosts that still did not after timeout seconds
+    """
+    start_time = time.time()
+    def wait_host(host):
+      command = self.ssh_command(host, "true", "-o ConnectTimeout=10")
+      for delay in backoff_delays(2.0, 15.0):
+        if self._call(command)[0] == 0:
+          return True
+        if time.time() + delay - start_time >= timeout:
+          return False
+        time.sleep(delay)
+    return [host for (host, (ready, exception)) in
+            zip(hosts, run_in_parallel(wait_host, hosts, self.max_workers))
+            if not ready]
+
+  def print_failures(self, results):
+    """
+    Print the output of the hosts whose commands failed.
+    @return: True if there were any failures
+    """
+    failed = False
+    for host in sorted(results.keys()):
+      (returncode, output) = results[host]
+      if returncode != 0:
+        print "Command on %s returned with value %s" % (host, returncode)
+        if output:
+          print output.rstrip()
+        failed = True
+    return failed
+
+  def close(self):
+    """
+    Close the master connections.
+    """
+    if self._hosts:
+      run_in_parallel(self._call,
+                      ["ssh %s -O exit root@%s" % (self._options, host)
+                       for host in self._hosts], self.max_workers)
+      self._hosts = set()
+    shutil.rmtree(self._control_dir, True)
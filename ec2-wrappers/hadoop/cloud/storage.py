@@ -17,8 +17,11 @@
 Classes for controlling external cluster storage.
 """
 
+import copy
 import logging
+import os
 import simplejson as json
+import tempfile
 
 logger = logging.getLogger(__name__)
 
@@ -67,33 +70,72 @@ class MountableVolume(object):
     self.device = device
 
 
+# Parsed storage files, by filename, as (file identity, contents); shared by
+# all the JsonVolumeManagers in the process.
+_json_cache = {}
+
 class JsonVolumeManager(object):
+  """
+  Keeps track of the volumes created for each instance in a role, in a JSON
+  file. The file is parsed at most once per change, and is always replaced
+  atomically so that an interrupted write cannot corrupt it.
+  """
 
   def __init__(self, filename):
     self.filename = filename
 
+  def _identity(self):
+    # A rename gives the file a new inode, so this changes on every _store,
+    # even within the resolution of the modification time.
+    st = os.stat(self.filename)
+    return (st.st_ino, st.st_mtime, st.st_size)
+
   def _load(self):
+    """
+    Return the parsed file. Callers must not modify the result.
+    """
     try:
-      return json.load(open(self.filename, "r"))
-    except IOError:
+      identity = self._identity()
+    except OSError:
       logger.debug("File %s does not exist.", self.filename)
       return {}
+    cached = _json_cache.get(self.filename)
+    if cached and cached[0] == identity:
+      return cached[1]
+    json_dict = json.load(open(self.filename, "r"))
+    _json_cache[self.filename] = (identity, json_dict)
+    return json_dict
 
   def _store(self, obj):
-    return json.dump(obj, open(self.filename, "w"), sort_keys=True, indent=2)
-  
+    (fd, temp_filename) = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(self.filename)),
+      prefix=os.path.basename(self.filename) + ".")
+    try:
+      f = os.fdopen(fd, "w")
+      try:
+        json.dump(obj, f, sort_keys=True, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+      finally:
+        f.close()
+      os.rename(temp_filename, self.filename)
+    except:
+      os.remove(temp_filename)
+      raise
+    _json_cache[self.filename] = (self._identity(), obj)
+
   def get_roles(self):
     json_dict = self._load()
     return json_dict.keys()
 
   def add_instance_storage_for_role(self, role, mountable_volumes):
-    json_dict = self._load()
+    json_dict = copy.deepcopy(self._load())
     mv_dicts = [mv.__dict__ for mv in mountable_volumes]
     json_dict.setdefault(role, []).append(mv_dicts)
     self._store(json_dict)
 
   def remove_instance_storage_for_role(self, role):
-    json_dict = self._load()
+    json_dict = copy.deepcopy(self._load())
     del json_dict[role]
     self._store(json_dict)
 
@@ -115,6 +157,110 @@ class JsonVolumeManager(object):
     except KeyError:
       return []
 
+class SqliteVolumeManager(object):
+  """
+  An alternative to JsonVolumeManager which keeps the volumes of any number of
+  clusters in one SQLite database, with each change made in a transaction.
+  """
+
+  def __init__(self, filename, cluster_name):
+    # Use the same SQLite binding as the usage and subaccount databases,
+    # falling back to the one bundled with Python 2.5 and later.
+    try:
+      from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+      import sqlite3
+    self.cluster_name = cluster_name
+    self.connection = sqlite3.connect(filename, isolation_level=None)
+    self.connection.executescript("""
+      CREATE TABLE IF NOT EXISTS imported (
+        cluster TEXT PRIMARY KEY
+      );
+      CREATE TABLE IF NOT EXISTS volumes (
+        cluster TEXT NOT NULL,
+        role TEXT NOT NULL,
+        instance INTEGER NOT NULL,
+        volume_id TEXT PRIMARY KEY,
+        mount_point TEXT,
+        device TEXT
+      );
+      CREATE INDEX IF NOT EXISTS volumes_by_role
+        ON volumes (cluster, role, instance);
+    """)
+
+  def import_json(self, json_volume_manager):
+    """
+    Copy the volumes from a JsonVolumeManager, once per cluster. The import is
+    recorded so that deleting all of a cluster's volumes later does not bring
+    back the ones in the (now stale) JSON file.
+    """
+    self.connection.execute("BEGIN IMMEDIATE TRANSACTION")
+    try:
+      if not self.connection.execute("""
+        SELECT 1 FROM imported WHERE cluster = ?
+      """, [self.cluster_name]).fetchone():
+        if not self.get_roles():
+          for role in json_volume_manager.get_roles():
+            for mountable_volumes in \
+                json_volume_manager.get_instance_storage_for_role(role):
+              self._insert_instance_storage(role, mountable_volumes)
+        self.connection.execute("""
+          INSERT INTO imported (cluster) VALUES (?)
+        """, [self.cluster_name])
+    except:
+      self.connection.execute("ROLLBACK")
+      raise
+    self.connection.execute("COMMIT")
+
+  def get_roles(self):
+    return [row[0] for row in self.connection.execute("""
+      SELECT DISTINCT role FROM volumes WHERE cluster = ?
+    """, [self.cluster_name])]
+
+  def add_instance_storage_for_role(self, role, mountable_volumes):
+    self.connection.execute("BEGIN IMMEDIATE TRANSACTION")
+    try:
+      self._insert_instance_storage(role, mountable_volumes)
+    except:
+      self.connection.execute("ROLLBACK")
+      raise
+    self.connection.execute("COMMIT")
+
+  def _insert_instance_storage(self, role, mountable_volumes):
+    instance = self.connection.execute("""
+      SELECT ifnull(MAX(instance) + 1, 0) FROM volumes
+        WHERE cluster = ? AND role = ?
+    """, [self.cluster_name, role]).fetchone()[0]
+    self.connection.executemany("""
+      INSERT INTO volumes (cluster, role, instance, volume_id, mount_point,
+                           device)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(self.cluster_name, role, instance, mv.volume_id, mv.mount_point,
+           mv.device) for mv in mountable_volumes])
+
+  def remove_instance_storage_for_role(self, role):
+    self.connection.execute("""
+      DELETE FROM volumes WHERE cluster = ? AND role = ?
+    """, [self.cluster_name, role])
+
+  def get_instance_storage_for_role(self, role):
+    """
+    Returns a list of lists of MountableVolume objects. Each nested list is
+    the storage for one instance.
+    """
+    instance_storage = []
+    last_instance = None
+    for (instance, volume_id, mount_point, device) in self.connection.execute("""
+      SELECT instance, volume_id, mount_point, device FROM volumes
+        WHERE cluster = ? AND role = ? ORDER BY instance, rowid
+    """, [self.cluster_name, role]):
+      if instance != last_instance:
+        instance_storage.append([])
+        last_instance = instance
+      instance_storage[-1].append(MountableVolume(volume_id, mount_point,
+                                                  device))
+    return instance_storage
+
 class Storage(object):
   """
   Storage volumes for a cluster. The storage is associated with a named
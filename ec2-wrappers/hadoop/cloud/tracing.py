@@ -0,0 +1,131 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Opt-in timing of the phases of a command.
+
+When enabled, each phase appends one JSON object per line to the trace file
+as it finishes, with its name (nested phases are joined with "/"), start
+time, wall time in seconds, the number of EC2 API calls made during it, by
+action, and the number of retries (waits between polls or attempts). Counts
+include those of nested phases. Every line also carries the fields given to
+enable, and an id shared by all the lines of one command.
+"""
+
+from __future__ import with_statement
+
+import os
+import simplejson as json
+import threading
+import time
+import uuid
+
+_lock = threading.Lock()
+_file = None
+_fields = {}
+_phases = [] # the phases in progress, outermost first
+
+class _Phase(object):
+
+  def __init__(self, name, fields):
+    self.name = name
+    self.fields = fields
+    self.api_calls = {}
+    self.retries = 0
+
+  def __enter__(self):
+    if _file is None:
+      return self
+    with _lock:
+      if _phases:
+        self.name = "%s/%s" % (_phases[-1].name, self.name)
+      _phases.append(self)
+    self.start_time = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if _file is None:
+      return False
+    record = dict(_fields)
+    record.update(self.fields)
+    record.update({
+      'phase': self.name,
+      'start': self.start_time,
+      'seconds': round(time.time() - self.start_time, 3),
+      'api_calls': self.api_calls,
+      'retries': self.retries,
+      'ok': exc_type is None,
+    })
+    with _lock:
+      _phases.remove(self)
+      _file.write(json.dumps(record, sort_keys=True) + "\n")
+      _file.flush()
+    return False
+
+def phase(name, **fields):
+  """
+  Return a context manager which traces the code it runs as a phase. The
+  fields are added to the phase's trace line.
+  """
+  return _Phase(name, fields)
+
+def traced(name):
+  """
+  A decorator which traces each call of a method or function as a phase.
+  """
+  def decorate(function):
+    def wrapper(*args, **kwargs):
+      with phase(name):
+        return function(*args, **kwargs)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+  return decorate
+
+def count_api_call(action):
+  if _file is None:
+    return
+  with _lock:
+    for p in _phases:
+      p.api_calls[action] = p.api_calls.get(action, 0) + 1
+
+def count_retry():
+  if _file is None:
+    return
+  with _lock:
+    for p in _phases:
+      p.retries += 1
+
+def enable(filename, **fields):
+  """
+  Start appending phases to the given trace file.
+  """
+  global _file, _fields
+  _fields = dict(fields)
+  _fields['id'] = uuid.uuid4().hex
+  _fields['pid'] = os.getpid()
+  _file = open(filename, "a")
+  _count_boto_requests()
+
+def _count_boto_requests():
+  from boto.connection import AWSQueryConnection
+  make_request = AWSQueryConnection.make_request
+  if getattr(make_request, 'traced', False):
+    return
+  def counting_make_request(self, action, *args, **kwargs):
+    count_api_call(action)
+    return make_request(self, action, *args, **kwargs)
+  counting_make_request.traced = True
+  AWSQueryConnection.make_request = counting_make_request
@@ -18,7 +18,10 @@ Utility functions.
 """
 
 import ConfigParser
-import socket
+from hadoop.cloud import tracing
+import Queue
+import random
+import threading
 import urllib2
 
 def bash_quote(text):
@@ -31,7 +34,8 @@ def bash_quote_env(env):
   """Quotes the value in an environment variable assignment."""
   if env.find("=") == -1:
     return env
-  (var, value) = env.split("=")
+  # Only the first "=" separates the name; the value may contain more
+  (var, value) = env.split("=", 1)
   return "%s=%s" % (var, bash_quote(value))
 
 def build_env_string(env_strings=[], pairs={}):
@@ -68,17 +72,55 @@ def url_get(url, timeout=10, retries=0):
   """
   Retrieve content from the given URL.
   """
-   # in Python 2.6 we can pass timeout to urllib2.urlopen
-  socket.setdefaulttimeout(timeout)
   attempts = 0
   while True:
     try:
-      return urllib2.urlopen(url).read()
+      return urllib2.urlopen(url, timeout=timeout).read()
     except urllib2.URLError:
       attempts = attempts + 1
       if attempts > retries:
         raise
 
+def backoff_delays(initial=1.0, maximum=30.0, factor=1.5):
+  """
+  Generate an endless sequence of polling delays, growing geometrically from
+  initial up to maximum, each with up to 50% random jitter so that many
+  pollers started together don't call the API in lockstep.
+  """
+  delay = initial
+  while True:
+    tracing.count_retry()
+    yield delay * random.uniform(0.5, 1.0)
+    delay = min(delay * factor, maximum)
+
+def run_in_parallel(function, items, max_workers=10):
+  """
+  Call function on each of items, using up to max_workers threads. Returns a
+  list with an (result, exception) pair for each item, in the order of items;
+  exception is None if the call succeeded.
+  """
+  work = Queue.Queue()
+  for index in range(len(items)):
+    work.put(index)
+  results = [None] * len(items)
+  def worker():
+    while True:
+      try:
+        index = work.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[index] = (function(items[index]), None)
+      except Exception, e:
+        results[index] = (None, e)
+  threads = [threading.Thread(target=worker)
+             for i in range(min(max_workers, len(items)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return results
+
 def xstr(string):
   """Sane string conversion: return an empty string if string is None."""
   return '' if string is None else str(string)
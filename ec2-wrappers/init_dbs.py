@@ -4,3 +4,6 @@ import record_usage
 
 subaccounts.init_db()
 record_usage.init_db()
+
+for (query, detail) in record_usage.check_query_plans():
+    print "WARNING: usage query not using an index (%s): %s" % (detail, query)
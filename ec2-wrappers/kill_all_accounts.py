@@ -1,4 +1,5 @@
 import subaccounts
+import sys
 
 iam_root = subaccounts.get_root_IAM_connection()
 
@@ -9,7 +10,9 @@ if maybe_yes != "yes":
     sys.exit(1)
 
 subaccounts.init_db()
-for user in iam_root.get_all_users()['list_users_response']['list_users_result']['users']:
-    print "Deleting user ", user
-    subaccounts.delete_user(user['user_name'])
+user_names = [user['user_name'] for user in iam_root.get_all_users()['list_users_response']['list_users_result']['users']]
+print "Deleting %d users" % (len(user_names))
+failures = subaccounts.delete_users(user_names)
+for (user_name, e) in failures.items():
+    print "Failed to delete user %s: %s" % (user_name, e)
 
@@ -13,20 +13,36 @@ def get_root_creds():
         fh.close()
     return root_creds
 
-    
+
+# Connections are shared process-wide, keyed by class, credentials and any
+# endpoint arguments, so that repeated calls reuse the keep-alive HTTPS
+# connections boto pools inside each connection object.
+connections = {}
+def get_cached_connection(cls, aws_access_key_id, aws_secret_access_key,
+                          **kwargs):
+    key = (cls, aws_access_key_id, aws_secret_access_key,
+           tuple(sorted(kwargs.items())))
+    if key not in connections:
+        connections[key] = cls(
+            aws_access_key_id = aws_access_key_id,
+            aws_secret_access_key = aws_secret_access_key,
+            debug = 0,
+            **kwargs
+        )
+    return connections[key]
+
 def get_root_ec2_connection():
     creds = get_root_creds()
-    return EC2Connection(
-        aws_access_key_id = str(creds['aws_access_key_id']),
-        aws_secret_access_key = str(creds['aws_secret_access_key']),
-        debug = 0
+    return get_cached_connection(
+        EC2Connection,
+        str(creds['aws_access_key_id']),
+        str(creds['aws_secret_access_key'])
     )
 
 def get_root_IAM_connection():
     creds = get_root_creds()
-    return IAMConnection(
-        aws_access_key_id = str(creds['aws_access_key_id']),
-        aws_secret_access_key = str(creds['aws_secret_access_key']),
-        debug = 0
+    return get_cached_connection(
+        IAMConnection,
+        str(creds['aws_access_key_id']),
+        str(creds['aws_secret_access_key'])
     )
-
@@ -1,5 +1,7 @@
 from myec2 import get_root_ec2_connection
+from boto.ec2.lister import reservation_lister
 import datetime
+import re
 import simplejson
 #import sqlite3
 from pysqlite2 import dbapi2 as sqlite3
@@ -10,8 +12,39 @@ dbh = sqlite3.connect(USAGE_DB_FILE, isolation_level=None)
 
 # BUG: pending_instance_times doesn't deal with now-stopped instances correctly
 
+# Bump this when the views or indexes below change; init_db() drops the old
+# views of a database with a lower PRAGMA user_version so they are recreated.
+SCHEMA_VERSION = 1
+
 def init_db():
+    have_rollup = len(dbh.execute("""
+        SELECT 1 FROM sqlite_master WHERE name = 'user_cost_rollup'
+    """).fetchall()) > 0
+    old_version = dbh.execute("PRAGMA user_version").fetchone()[0]
+    migrate = ""
+    if old_version < SCHEMA_VERSION:
+        # Databases from before version 1 stored stopped_time (and
+        # running_time) as ISO text rather than julian days, and added an
+        # open instance_stopped row on every sweep an instance stayed
+        # stopped; keep only the earliest open row of each instance.
+        migrate = """
+            UPDATE instance_stopped SET stopped_time = julianday(stopped_time)
+                WHERE typeof(stopped_time) = 'text';
+            UPDATE instance_stopped SET running_time = julianday(running_time)
+                WHERE typeof(running_time) = 'text';
+            DELETE FROM instance_stopped
+                WHERE running_time IS NULL AND stopped_time > (
+                    SELECT MIN(stopped_time) FROM instance_stopped AS earliest
+                        WHERE earliest.instance_id = instance_stopped.instance_id
+                        AND earliest.running_time IS NULL
+                );
+
+            DROP VIEW IF EXISTS finished_instance_times;
+            DROP VIEW IF EXISTS pending_instances;
+            DROP VIEW IF EXISTS pending_instance_times;
+        """
     dbh.executescript("""
+        BEGIN IMMEDIATE TRANSACTION;
         CREATE TABLE IF NOT EXISTS instances (
             instance_id TEXT PRIMARY KEY,
             instance_type TEXT NOT NULL,
@@ -35,6 +68,29 @@ def init_db():
             username TEXT NOT NULL
         );
 
+        -- Billed hours of finished instances, maintained by update_instances
+        CREATE TABLE IF NOT EXISTS user_cost_rollup (
+            username TEXT NOT NULL,
+            is_spot BOOLEAN,
+            instance_type TEXT NOT NULL,
+            hours REAL NOT NULL,
+            PRIMARY KEY(username, is_spot, instance_type)
+        );
+
+        %(migrate)s
+
+        -- Covers the per-user report queries over the views below
+        CREATE INDEX IF NOT EXISTS instances_by_user ON instances (
+            username, end_time, is_spot, instance_type, start_time
+        );
+        CREATE INDEX IF NOT EXISTS instances_by_end_time ON instances (
+            end_time
+        );
+        CREATE INDEX IF NOT EXISTS instance_stopped_by_instance
+            ON instance_stopped (instance_id, running_time, stopped_time);
+        CREATE INDEX IF NOT EXISTS pending_spot_requests_by_user
+            ON pending_spot_requests (username, instance_type);
+
         CREATE VIEW IF NOT EXISTS instance_stopped_time AS
             SELECT
                 instance_id,
@@ -47,17 +103,25 @@ def init_db():
             )
             GROUP BY instance_id;
 
+        -- The stopped time is a correlated subquery rather than a join against
+        -- instance_stopped_time so that a username predicate on these views
+        -- is answered from instances_by_user instead of aggregating all of
+        -- instance_stopped first.
         CREATE VIEW IF NOT EXISTS finished_instance_times AS
             SELECT
-                instances.instance_id AS instance_id,
+                instance_id,
                 instance_type,
-                round(24*(instances.end_time - instances.start_time) - 
-                    ifnull(instance_stopped_time.hours, 0) + .5) AS hours,
+                round(24*(end_time - start_time) - ifnull((
+                    SELECT SUM(running_time - stopped_time)*24
+                        FROM instance_stopped
+                        WHERE instance_stopped.instance_id =
+                            instances.instance_id
+                        AND stopped_time IS NOT NULL
+                ), 0) + .5) AS hours,
                 is_spot,
                 username
-                FROM instances LEFT OUTER JOIN instance_stopped_time
-                    ON instances.instance_id = instance_stopped_time.instance_id
-                WHERE instances.end_time IS NOT NULL;
+                FROM instances
+                WHERE end_time IS NOT NULL;
 
         CREATE VIEW IF NOT EXISTS pending_instances AS
             SELECT instance_id, instance_type, start_time, is_spot, username FROM instances
@@ -65,16 +129,62 @@ def init_db():
 
         CREATE VIEW IF NOT EXISTS pending_instance_times AS
             SELECT
-                instances.instance_id AS instance_id,
+                instance_id,
                 instance_type,
-                round(24*(julianday('now') - instances.start_time) - 
-                    ifnull(instance_stopped_time.hours, 0) + .5) AS hours,
+                round(24*(julianday('now') - start_time) - ifnull((
+                    SELECT SUM(running_time - stopped_time)*24
+                        FROM instance_stopped
+                        WHERE instance_stopped.instance_id =
+                            instances.instance_id
+                        AND stopped_time IS NOT NULL
+                ), 0) + .5) AS hours,
                 is_spot,
                 username
-                FROM instances LEFT OUTER JOIN instance_stopped_time
-                    ON instances.instance_id = instance_stopped_time.instance_id
-                WHERE instances.end_time IS NULL;
+                FROM instances
+                WHERE end_time IS NULL;
+
+        PRAGMA user_version = %(version)d;
+        COMMIT;
+    """ % { 'migrate': migrate, 'version': SCHEMA_VERSION })
+    if not have_rollup:
+        rebuild_cost_rollup()
+
+# Queries which must stay on an index as the usage database grows; see
+# check_query_plans().
+INDEXED_QUERIES = [
+    "SELECT is_spot, instance_type, SUM(hours) FROM finished_instance_times"
+    " WHERE username = 'x' GROUP BY is_spot, instance_type",
+    "SELECT is_spot, instance_type, SUM(hours) FROM pending_instance_times"
+    " WHERE username = 'x' GROUP BY is_spot, instance_type",
+    "SELECT is_spot, instance_type, hours FROM user_cost_rollup"
+    " WHERE username = 'x'",
+    "SELECT instance_type, COUNT(*) FROM pending_spot_requests"
+    " WHERE username = 'x' GROUP BY instance_type",
+    "SELECT username, is_spot, instance_type, hours"
+    " FROM pending_instance_times",
+]
+
+# Returns a list of (query, plan step) for each of INDEXED_QUERIES that
+# SQLite would answer with a full table scan; empty if all use an index.
+def check_query_plans():
+    problems = []
+    for query in INDEXED_QUERIES:
+        for row in dbh.execute("EXPLAIN QUERY PLAN " + query):
+            detail = row[-1]
+            if re.match(r"SCAN (TABLE )?\w+( AS \w+)?( \(|$)", detail):
+                problems.append((query, detail))
+    return problems
+
+def rebuild_cost_rollup():
+    dbh.execute("BEGIN IMMEDIATE TRANSACTION")
+    dbh.execute("DELETE FROM user_cost_rollup")
+    dbh.execute("""
+        INSERT INTO user_cost_rollup (username, is_spot, instance_type, hours)
+            SELECT username, is_spot, instance_type, SUM(hours)
+                FROM finished_instance_times
+                GROUP BY username, is_spot, instance_type
     """)
+    dbh.execute("COMMIT")
 
 def user_from_key(key_name): 
     if key_name.startswith("cs"):
@@ -82,71 +192,124 @@ def user_from_key(key_name):
     else:
         return key_name.split("-")[0]
 
+# Load a DescribeInstances snapshot into the seen_instances temp table.
+# Only the connection-private temp database is written here, so this does not
+# take the usage database write lock.
+def _stage_instances(all_instances):
+    rows = []
+    for reservation in all_instances:
+        for instance in reservation.instances:
+            if instance.spot_instance_request_id != None:
+                is_spot = 1
+            else:
+                is_spot = 0
+            rows.append([instance.id, instance.instance_type,
+                         instance.launch_time, instance.state, is_spot,
+                         user_from_key(instance.key_name)])
+    dbh.execute("BEGIN TRANSACTION")
+    dbh.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS seen_instances (
+            instance_id TEXT PRIMARY KEY,
+            instance_type TEXT NOT NULL,
+            start_time TEXT,
+            state TEXT,
+            is_spot BOOLEAN,
+            username TEXT NOT NULL,
+            finishing BOOLEAN DEFAULT 0
+        )
+    """)
+    dbh.execute("DELETE FROM seen_instances")
+    dbh.executemany("""
+        INSERT OR REPLACE INTO seen_instances (
+            instance_id, instance_type, start_time, state, is_spot, username
+        ) VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    dbh.execute("COMMIT")
+
 def update_instances(username = None):
     ec2 = get_root_ec2_connection()
     use_filter = None
     if username:
         use_filter = { 'key-name': "%s*" % username }
-    all_instances = ec2.get_all_instances(filters=use_filter)
+    # Streamed page by page, so only the rows (not the parsed responses) are
+    # held at once.
+    _stage_instances(reservation_lister(ec2, filters=use_filter,
+                                        compact=True))
     now = datetime.datetime.utcnow().isoformat()
-    for reservation in all_instances:
-        for instance in reservation.instances:
-            # We can safely import each instance as a transaction.
-            dbh.execute("BEGIN IMMEDIATE TRANSACTION")
-            username = user_from_key(instance.key_name)
-            start_time = instance.launch_time
-            is_spot = instance.spot_instance_request_id != None
-            if is_spot:
-                is_spot = 1
-            else:
-                is_spot = 0
-            old_end_time = None
-            for row in dbh.execute("""
-                SELECT end_time FROM instances WHERE instance_id = ?
-            """, [instance.id]):
-                old_end_time = row[0]
-            old_stop_time = None
-            for row in dbh.execute("""
-                SELECT stopped_time FROM instance_stopped WHERE instance_id = ?
-                    AND running_time IS NULL
-            """, [instance.id]):
-                old_stop_time = row[0]
-            if instance.state == 'terminated' and old_end_time == None:
-                dbh.execute("""
-                    INSERT OR REPLACE INTO instances (
-                        instance_id, instance_type, start_time, end_time,
-                        last_seen, is_spot, username
-                    ) VALUES (?, ?, julianday(?), julianday(?), julianday(?), ?, ?)
-                """, [instance.id, instance.instance_type, start_time, now,
-                      now, is_spot, username])
-            if instance.state != 'stopped' and instance.state != 'terminated' and old_stop_time != None:
-                dbh.execute("""
-                    UPDATE instance_stopped WHERE
-                        instance_id = ? AND stopped_time = ?
-                    SET running_time = ?
-                """, [instance.id, old_stop_time, now])
-            if instance.state != 'terminated':
-                dbh.execute("""
-                    INSERT OR REPLACE INTO instances (
-                        instance_id, instance_type, start_time,
-                        last_seen, is_spot, username
-                    ) VALUES (?, ?, julianday(?), julianday(?), ?, ?)
-                    """, [instance.id, instance.instance_type,
-                          start_time, now, is_spot, username])
-            if instance.state == 'stopped':
-                dbh.execute("""
-                    INSERT INTO instance_stopped (instance_id, stopped_time)
-                        VALUES (?, ?)
-                """, [instance.id, now])
-
-            dbh.execute("COMMIT")
+
+    # Reconcile the whole snapshot at once so the write lock is taken once
+    # per sweep rather than once per instance.
+    dbh.execute("BEGIN IMMEDIATE TRANSACTION")
+    # Newly terminated instances (including ones we never saw running).
+    dbh.execute("""
+        UPDATE seen_instances SET finishing = 1
+            WHERE state = 'terminated' AND NOT EXISTS (
+                SELECT 1 FROM instances
+                    WHERE instances.instance_id = seen_instances.instance_id
+                    AND end_time IS NOT NULL
+            )
+    """)
+    dbh.execute("""
+        INSERT OR REPLACE INTO instances (
+            instance_id, instance_type, start_time, end_time,
+            last_seen, is_spot, username
+        ) SELECT
+            instance_id, instance_type, julianday(start_time),
+            julianday(?), julianday(?), is_spot, username
+            FROM seen_instances WHERE finishing
+    """, [now, now])
+    dbh.execute("""
+        INSERT OR REPLACE INTO user_cost_rollup (
+            username, is_spot, instance_type, hours
+        ) SELECT
+            finished.username, finished.is_spot, finished.instance_type,
+            ifnull(user_cost_rollup.hours, 0) + finished.hours
+            FROM (
+                SELECT username, is_spot, instance_type, SUM(hours) AS hours
+                    FROM finished_instance_times WHERE instance_id IN (
+                        SELECT instance_id FROM seen_instances WHERE finishing
+                    )
+                    GROUP BY username, is_spot, instance_type
+            ) AS finished LEFT OUTER JOIN user_cost_rollup
+                ON finished.username = user_cost_rollup.username
+                    AND finished.is_spot = user_cost_rollup.is_spot
+                    AND finished.instance_type = user_cost_rollup.instance_type
+    """)
+    # Instances which have come back from being stopped.
+    dbh.execute("""
+        UPDATE instance_stopped SET running_time = julianday(?)
+            WHERE running_time IS NULL AND instance_id IN (
+                SELECT instance_id FROM seen_instances
+                    WHERE state != 'stopped' AND state != 'terminated'
+            )
+    """, [now])
+    dbh.execute("""
+        INSERT OR REPLACE INTO instances (
+            instance_id, instance_type, start_time,
+            last_seen, is_spot, username
+        ) SELECT
+            instance_id, instance_type, julianday(start_time),
+            julianday(?), is_spot, username
+            FROM seen_instances WHERE state != 'terminated'
+    """, [now])
+    # Instances which have just been stopped.
+    dbh.execute("""
+        INSERT INTO instance_stopped (instance_id, stopped_time)
+            SELECT instance_id, julianday(?) FROM seen_instances
+                WHERE state = 'stopped' AND instance_id NOT IN (
+                    SELECT instance_id FROM instance_stopped
+                        WHERE running_time IS NULL
+                )
+    """, [now])
+    dbh.execute("COMMIT")
 
 def update_spot_requests(username=None):
     ec2 = get_root_ec2_connection()
     use_filter = None
     if username:
         use_filter = {'launch.key_name': "%s*" % (username)}
-    requests = ec2.get_all_spot_instance_requests(filters=use_filter)
+    requests = ec2.get_all_spot_instance_requests(filters=use_filter,
+                                                  compact=True)
 
     dbh.execute("BEGIN IMMEDIATE TRANSACTION")
     if username:
@@ -195,13 +358,17 @@ def spot_to_type(is_spot):
     else:
         return "demand"
 
+def hourly_estimate(is_spot, instance_type):
+    estimate = INSTANCE_COST[instance_type] * COST_BASE
+    if is_spot:
+        estimate *= SPOT_FACTOR
+    return estimate
+
 def report_set(instance_hour_set):
     result = ""
     total = 0.0
     for (is_spot, instance_type, hours) in instance_hour_set:
-        estimate = INSTANCE_COST[instance_type] * COST_BASE
-        if is_spot:
-            estimate *= SPOT_FACTOR
+        estimate = hourly_estimate(is_spot, instance_type)
         subtotal = estimate * hours
         total += subtotal
         result += "%(hours)5d hours of %(type)10s (%(spot)s) @ $%(estimate)5.3f = $%(subtotal)6.3f\n" % {
@@ -223,9 +390,8 @@ def user_report(username, include_pending=True, include_live=True):
         update_spot_requests(username)
 
     finished_instances = dbh.execute("""
-        SELECT is_spot, instance_type, SUM(hours) AS hours FROM
-            finished_instance_times WHERE username = ?
-            GROUP BY is_spot, instance_type
+        SELECT is_spot, instance_type, hours FROM
+            user_cost_rollup WHERE username = ?
     """, [username]).fetchall()
 
     pending_instances = dbh.execute("""
@@ -258,8 +424,29 @@ def user_report(username, include_pending=True, include_live=True):
     
     return (result, total)
 
+def live_instance_counts():
+    return dbh.execute("""
+        SELECT username, instance_type, COUNT(*) FROM pending_instances
+            GROUP BY username, instance_type
+    """).fetchall()
+
 def users():
     return map(lambda x:x[0], dbh.execute("""
         SELECT DISTINCT username FROM instances
     """).fetchall())
-    
+
+# Same totals as user_report(user, include_live=False) for every user, in one
+# pass over the rollup rather than three queries per user.
+def user_totals():
+    totals = {}
+    for (username, is_spot, instance_type, hours) in dbh.execute("""
+        SELECT username, is_spot, instance_type, hours FROM user_cost_rollup
+        UNION ALL
+        SELECT username, is_spot, instance_type, hours
+            FROM pending_instance_times
+        UNION ALL
+        SELECT username, 1, instance_type, 1 FROM pending_spot_requests
+    """):
+        totals[username] = totals.get(username, 0.0) + \
+            hourly_estimate(is_spot, instance_type) * hours
+    return sorted(totals.items())
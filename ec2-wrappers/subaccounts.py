@@ -14,7 +14,14 @@ import random
 
 import exceptions
 
+import threading
+import time
+import Queue
+
+from boto.exception import BotoServerError
+
 from myec2 import get_root_ec2_connection, get_root_IAM_connection
+from myec2 import get_cached_connection
 
 # Security note: need to disable debug logging to end-user so they
 # won't see our "real" access key/secret access key
@@ -42,6 +49,12 @@ def init_db():
             private_key TEXT,
             fingerprint TEXT
         );
+        CREATE TABLE IF NOT EXISTS live_costs (
+            user_name TEXT PRIMARY KEY,
+            cost REAL NOT NULL,
+            refresh_time REAL NOT NULL,
+            change_time REAL NOT NULL
+        );
     """)
 
 root_creds = None
@@ -62,6 +75,10 @@ SPOT_BASE = .086
 
 SPEND_LIMIT = 60
 
+# How old (in seconds) a cached live cost may be before run_instances() stops
+# trusting it and asks EC2 instead. The usage cron refreshes the cache.
+LIVE_COST_MAX_AGE = 15 * 60
+
 def user_exists(user_name):
     found_user = False
     for row in dbh.execute("""
@@ -109,17 +126,17 @@ class User:
             self.init_ec2()
 
     def init_iam(self):
-        self.iam = IAMConnection(
-            aws_access_key_id = self.access_keys[0]['key'],
-            aws_secret_access_key = self.access_keys[0]['secret_key'],
-            debug = 0
+        self.iam = get_cached_connection(
+            IAMConnection,
+            self.access_keys[0]['key'],
+            self.access_keys[0]['secret_key']
         )
 
     def init_ec2(self):
-        self.ec2 = EC2Connection(
-            aws_access_key_id = self.access_keys[0]['key'],
-            aws_secret_access_key = self.access_keys[0]['secret_key'],
-            debug = 0
+        self.ec2 = get_cached_connection(
+            EC2Connection,
+            self.access_keys[0]['key'],
+            self.access_keys[0]['secret_key']
         )
 
     def get_access_keys(self):
@@ -223,6 +240,31 @@ class User:
         instances = self.running_instances()
         return sum(map(lambda x: INSTANCE_COST[x.instance_type], instances))
 
+    def cached_cost_instances(self):
+        for row in dbh.execute("""
+            SELECT cost FROM live_costs WHERE user_name = ?
+                AND (julianday('now') - refresh_time) * 86400 < ?
+        """, [self.user_name, LIVE_COST_MAX_AGE]):
+            return row[0]
+        return None
+
+    def set_cached_cost(self, cost):
+        dbh.execute("BEGIN EXCLUSIVE")
+        dbh.execute("""
+            INSERT OR REPLACE INTO live_costs (user_name, cost, refresh_time,
+                                               change_time)
+                VALUES (?, ?, julianday('now'), julianday('now'))
+        """, [self.user_name, cost])
+        dbh.execute("COMMIT")
+
+    def add_cached_cost(self, extra_cost):
+        dbh.execute("BEGIN EXCLUSIVE")
+        dbh.execute("""
+            UPDATE live_costs SET cost = cost + ?, change_time = julianday('now')
+                WHERE user_name = ?
+        """, [extra_cost, self.user_name])
+        dbh.execute("COMMIT")
+
     def cost_proposal(self, instance_type, num_instances):
         return INSTANCE_COST[instance_type] * num_instances
 
@@ -230,7 +272,6 @@ class User:
         info_without_ud = instance_info.copy()
         if 'user_data' in info_without_ud:
             del info_without_ud['user_data']
-        old_cost = self.cost_instances()
         extra_cost = self.cost_proposal(
             instance_info['instance_type'],
             instance_info['count']
@@ -238,6 +279,14 @@ class User:
         if not instance_info['key_name'].startswith(self.user_name):
             audit_log("Rejecting instance request %s (for %s) because of key" % (self.user_name, info_without_ud))
             raise Exception("Needs to be associated with SSH key")
+        # Between refreshes the cached cost can only overestimate (we add
+        # every launch to it, but don't see terminations, and set_live_costs
+        # keeps rows changed while it was listing instances), so only trust
+        # it to accept a request; check with EC2 before rejecting one.
+        old_cost = self.cached_cost_instances()
+        if old_cost is None or old_cost + extra_cost > SPEND_LIMIT:
+            old_cost = self.cost_instances()
+            self.set_cached_cost(old_cost)
         if old_cost + extra_cost > SPEND_LIMIT:
             audit_log("Rejecting instance request %s (for %s) because of cost" % (self.user_name, info_without_ud))
             raise Exception("Excessive instance cost")
@@ -258,6 +307,7 @@ class User:
                 placement=instance_info.get('availability_zone', None)
                 #, availability_zone_group=instance_info.get('placement_group', None)
             )
+            self.add_cached_cost(extra_cost)
             return spot_requests
         else:
             reservation = ec2.run_instances(
@@ -271,8 +321,45 @@ class User:
                 placement=instance_info.get('availability_zone', None)
                 #, placement_group=instance_info.get('placement_group', None)
             )
+            self.add_cached_cost(extra_cost)
             return reservation
 
+def live_costs_snapshot_time():
+    """
+    The time to pass to set_live_costs(), taken before listing the instances
+    it will be given.
+    """
+    return dbh.execute("SELECT julianday('now')").fetchone()[0]
+
+def set_live_costs(instance_counts, snapshot_time):
+    """
+    Replace the cached live cost of every user. instance_counts is a list of
+    (user_name, instance_type, number of live instances), as listed from EC2
+    after snapshot_time (see live_costs_snapshot_time()); users not listed
+    are recorded as having no live instances. Users whose cached cost was set
+    or added to after snapshot_time keep it, since the listing may not
+    include the instances behind that change.
+    """
+    costs = {}
+    for (user_name, instance_type, count) in instance_counts:
+        costs[user_name] = costs.get(user_name, 0) + \
+            INSTANCE_COST[instance_type] * count
+    dbh.execute("BEGIN EXCLUSIVE")
+    dbh.execute("""
+        DELETE FROM live_costs WHERE change_time < ?
+    """, [snapshot_time])
+    dbh.executemany("""
+        INSERT OR IGNORE INTO live_costs (user_name, cost, refresh_time,
+                                          change_time)
+            VALUES (?, ?, julianday('now'), julianday('now'))
+    """, costs.items())
+    dbh.execute("""
+        INSERT OR IGNORE INTO live_costs (user_name, cost, refresh_time,
+                                          change_time)
+            SELECT user_name, 0, julianday('now'), julianday('now') FROM users
+    """)
+    dbh.execute("COMMIT")
+
 def get_user_policy(user_name):
     # Might need modification to support non-class-account names.
     return """
@@ -296,42 +383,129 @@ def get_user_policy(user_name):
         }
     """ % { 'user_name': user_name }
 
+# Error codes AWS uses to ask us to slow down.
+THROTTLING_ERRORS = ('Throttling', 'RequestLimitExceeded')
+
+# Number of simultaneous IAM calls made by make_users()/delete_users().
+BULK_WORKERS = 8
+
+class ThrottledConnection:
+    """
+    Wraps a boto connection so that calls rejected for throttling are retried
+    with exponential backoff (plus jitter, so that worker threads don't retry
+    in lockstep) instead of failing.
+    """
+    def __init__(self, connection, max_retries=6, base_delay=0.5):
+        self.connection = connection
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    return attr(*args, **kwargs)
+                except BotoServerError, e:
+                    if (e.error_code not in THROTTLING_ERRORS or
+                        attempt >= self.max_retries):
+                        raise
+                delay = self.base_delay * (2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay))
+                attempt += 1
+        return call
+
+def run_parallel(function, items, workers=BULK_WORKERS):
+    """
+    Call function on each of items from a pool of at most workers threads.
+    Returns (results, failures): dicts mapping each item to function's return
+    value or to the exception it raised.
+    """
+    work = Queue.Queue()
+    for item in items:
+        work.put(item)
+    results = {}
+    failures = {}
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[item] = function(item)
+            except StandardError, e:
+                failures[item] = e
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (results, failures)
+
 def iam_delete_user(iam_root, user_name):
+    """
+    Remove a user's policies, groups and credentials. Does nothing if the
+    user does not exist; any other failure is raised, so that callers keep
+    the local records of users whose teardown did not finish.
+    """
+    # ensure user exists before continuing
+    audit_log("Trying to delete user %s" % (user_name))
     try:
-        # ensure user exists before continuing
-        auditlog("Trying to delete user %s" % (user_name))
         old_user_info = iam_root.get_user(user_name)
-
-        # delete group associations, keys, signing certs, polciies for user
-        for policy_name in iam_root.get_all_user_policies(user_name)['list_user_policies_response']['list_user_policies_result']['policy_names']:
-            iam_root.delete_user_policy(user_name, policy_name)
-        for group in iam_root.get_groups_for_user(user_name)['list_user_groups_response']['list_user_groups_result']:
-            iam_root.remove_user_from_group(group['group_name'], user_name)
-        # delete these credentials after we preventthem from being used to create
-        # more user credentials
-        for signing_cert in iam_root.get_all_signing_certs(user_name=user_name)['list_signing_certificates_response']['list_signing_certificates_result']['certificates']:
-            iam_root.delete_signing_cert(signing_cert['certificate_id'], user_name)
-        for access_key in iam_root.get_all_access_keys(user_name=user_name)['list_access_keys_response']['list_access_keys_result']['access_key_metadata']:
-            iam_root.delete_access_key(access_key['access_key_id'], user_name)
-    except StandardError, e:
-        pass
+    except BotoServerError, e:
+        if e.error_code == 'NoSuchEntity':
+            return
+        raise
+
+    # delete group associations, keys, signing certs, polciies for user
+    for policy_name in iam_root.get_all_user_policies(user_name)['list_user_policies_response']['list_user_policies_result']['policy_names']:
+        iam_root.delete_user_policy(user_name, policy_name)
+    for group in iam_root.get_groups_for_user(user_name)['list_user_groups_response']['list_user_groups_result']:
+        iam_root.remove_user_from_group(group['group_name'], user_name)
+    # delete these credentials after we preventthem from being used to create
+    # more user credentials
+    for signing_cert in iam_root.get_all_signing_certs(user_name=user_name)['list_signing_certificates_response']['list_signing_certificates_result']['certificates']:
+        iam_root.delete_signing_cert(signing_cert['certificate_id'], user_name)
+    for access_key in iam_root.get_all_access_keys(user_name=user_name)['list_access_keys_response']['list_access_keys_result']['access_key_metadata']:
+        iam_root.delete_access_key(access_key['access_key_id'], user_name)
 
 def random_password():
     s = ""
     LETTERS = "abcdefghijkmnopqrstuvwxyz023456789ABCDEFGHJKLMNOPQRSTUVWXYZ"
     for i in xrange(8):
-        s.append(random.choice(LETTERS))
+        s += random.choice(LETTERS)
     return s
 
-def delete_user(user_name):
-    iam_delete_user(get_root_IAM_connection(), user_name)
+def forget_users(user_names):
     dbh.execute("BEGIN EXCLUSIVE")
-    dbh.execute("""DELETE FROM users WHERE user_name = ?""", [user_name])
+    dbh.executemany("""DELETE FROM access_keys WHERE user_name = ?""",
+        [[user_name] for user_name in user_names])
+    dbh.executemany("""DELETE FROM users WHERE user_name = ?""",
+        [[user_name] for user_name in user_names])
     dbh.execute("COMMIT")
 
-def make_user(user_name):
+def delete_user(user_name):
+    iam_delete_user(get_root_IAM_connection(), user_name)
+    forget_users([user_name])
+
+def delete_users(user_names):
+    """
+    Delete many users at once, making the IAM calls from a pool of threads.
+    Returns a dict of the users whose deletion failed, with the exception.
+    """
+    iam_root = ThrottledConnection(get_root_IAM_connection())
+    (results, failures) = run_parallel(
+        lambda user_name: iam_delete_user(iam_root, user_name), user_names)
+    forget_users(results.keys())
+    return failures
+
+def iam_make_user(iam_root, user_name):
     audit_log("Creating user %s" % (user_name))
-    iam_root = get_root_IAM_connection()
     iam_delete_user(iam_root, user_name)
     iam_root.create_user(user_name)
     iam_root.add_user_to_group("students", user_name)
@@ -342,12 +516,34 @@ def make_user(user_name):
     )
     password = random_password()
     iam_root.create_login_profile(user_name, password)
+    return password
+
+def record_users(passwords):
     now = datetime.datetime.utcnow().isoformat()
+    creator = real_username()
     dbh.execute("BEGIN EXCLUSIVE")
-    dbh.execute("""
+    dbh.executemany("""
         INSERT OR REPLACE INTO users (user_name, create_time, create_account, login_password)
             VALUES (?, ?, ?, ?)
-    """, [user_name, now, real_username(), password])
+    """, [[user_name, now, creator, password]
+          for (user_name, password) in passwords.items()])
     dbh.execute("COMMIT;")
+
+def make_user(user_name):
+    password = iam_make_user(get_root_IAM_connection(), user_name)
+    record_users({ user_name: password })
     user = User(user_name)
     return user
+
+def make_users(user_names):
+    """
+    Create many users at once, making the IAM calls from a pool of threads.
+    Returns (users, failures): the created Users, and a dict of the users
+    whose creation failed, with the exception.
+    """
+    iam_root = ThrottledConnection(get_root_IAM_connection())
+    (passwords, failures) = run_parallel(
+        lambda user_name: iam_make_user(iam_root, user_name), user_names)
+    record_users(passwords)
+    users = [User(user_name) for user_name in passwords]
+    return (users, failures)
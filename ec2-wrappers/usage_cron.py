@@ -1,6 +1,10 @@
 #!/usr/bin/python
 import record_usage
+import subaccounts
 
 record_usage.init_db()
+subaccounts.init_db()
+snapshot_time = subaccounts.live_costs_snapshot_time()
 record_usage.update_instances()
 record_usage.update_spot_requests()
+subaccounts.set_live_costs(record_usage.live_instance_counts(), snapshot_time)
@@ -17,8 +17,7 @@ if username != 'ALL':
     print "estimated total spending = $%6.3f" % (total)
 else:
     overall_total = 0.0
-    for user in record_usage.users():
-        (desc, total) = record_usage.user_report(user, include_live=False)
+    for (user, total) in record_usage.user_totals():
         print "%-20s $%6.3f" % (user, total)
         overall_total += total
     print "(sum = $%6.3f)" % (overall_total)